@@ -0,0 +1,144 @@
+"""
+A synthetic news site for benchmarking diffengine without touching the
+network. Articles are generated from a seed so every run sees the same
+text, and each round a change_rate fraction of them are edited. Feeds
+look like the ones in test-data/, and both feeds and articles are served
+with ETags so that conditional requests work like they do on real sites.
+
+    corpus = Corpus(entries=1000, per_feed=100, change_rate=0.1)
+    server, base_url = serve(corpus)
+    corpus.round += 1   # edit some of the articles
+"""
+
+import random
+import hashlib
+import threading
+
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = """
+the a of to and in that is for on it with as was he said his at by from
+be have has had are an they who which not this but or were been their
+would we more will one about after new also year first two government
+police people city president state officials report court told week
+minister house federal election campaign company market percent health
+school workers council investigation statement according spokesman
+""".split()
+
+
+class Corpus(object):
+
+    def __init__(self, entries=1000, per_feed=100, change_rate=0.1,
+                 paragraphs=8, seed=0):
+        self.entries = entries
+        self.per_feed = per_feed
+        self.feeds = max((entries + per_feed - 1) // per_feed, 1)
+        self.change_rate = change_rate
+        self.paragraphs = paragraphs
+        self.seed = seed
+        self.round = 0
+
+    def version(self, i):
+        """
+        How many times article i has been edited by the current round.
+        """
+        return sum(1 for r in range(1, self.round + 1)
+                   if self._random(i, r).random() < self.change_rate)
+
+    def article(self, i):
+        version = self.version(i)
+        rng = self._random(i, 0)
+        title = self._sentence(rng, 8).rstrip(".")
+        paras = [self._paragraph(rng) for p in range(self.paragraphs)]
+        # each edit rewrites one of the paragraphs
+        for v in range(1, version + 1):
+            edit = self._random(i, -v)
+            paras[edit.randrange(len(paras))] = self._paragraph(edit)
+        body = "".join("<p>%s</p>\n" % p for p in paras)
+        html = ("<html><head><title>%s</title></head><body>"
+                "<header><nav><a href='/'>Home</a></nav></header>"
+                "<article><h1>%s</h1>\n%s</article>"
+                "<footer>Copyright</footer></body></html>") % (title, title, body)
+        return html, '"%s-%s"' % (i, version)
+
+    def feed(self, f, base_url):
+        start = f * self.per_feed
+        end = min(start + self.per_feed, self.entries)
+        items = []
+        for i in range(start, end):
+            title = self._sentence(self._random(i, 0), 8).rstrip(".")
+            items.append(
+                "<item><title><![CDATA[%s]]></title><link>%s</link>"
+                "<description><![CDATA[%s]]></description></item>" %
+                (title, escape(self.article_url(i, base_url)), title))
+        xml = ('<?xml version="1.0" encoding="UTF-8"?>'
+               '<rss version="2.0"><channel><title>Feed %s</title>'
+               '<link>%s</link><description>Synthetic feed</description>'
+               '%s</channel></rss>') % (f, base_url, "".join(items))
+        return xml, '"feed-%s-%s"' % (f, self.entries)
+
+    def feed_url(self, f, base_url):
+        return "%s/feed/%s.xml" % (base_url, f)
+
+    def article_url(self, i, base_url):
+        return "%s/article/%s" % (base_url, i)
+
+    def _random(self, i, r):
+        key = ("%s:%s:%s" % (self.seed, i, r)).encode("utf8")
+        return random.Random(hashlib.sha1(key).hexdigest())
+
+    def _sentence(self, rng, n):
+        words = [rng.choice(WORDS) for w in range(n)]
+        return " ".join(words).capitalize() + "."
+
+    def _paragraph(self, rng):
+        return " ".join(self._sentence(rng, rng.randint(8, 20))
+                        for s in range(rng.randint(3, 6)))
+
+
+def serve(corpus, host="127.0.0.1", port=0):
+    """
+    Starts serving the corpus in a background thread and returns the
+    server and its base url.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            base_url = "http://%s:%s" % self.server.server_address[:2]
+            parts = self.path.strip("/").split("/")
+            try:
+                if parts[0] == "feed":
+                    body, etag = corpus.feed(int(parts[1].split(".")[0]), base_url)
+                    ctype = "application/rss+xml"
+                elif parts[0] == "article":
+                    body, etag = corpus.article(int(parts[1]))
+                    ctype = "text/html"
+                else:
+                    raise ValueError()
+            except (IndexError, ValueError):
+                self.send_error(404)
+                return
+
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+
+            body = body.encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", ctype + "; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://%s:%s" % server.server_address[:2]
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Measures how long it takes to import diffengine, and how much memory that
+uses, in a fresh interpreter. Prints a line of JSON so that the numbers can
+be compared across releases.
+
+    % python benchmarks/startup.py --runs 10
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+
+PROBE = """
+import time, resource
+t = time.perf_counter()
+import diffengine
+elapsed = time.perf_counter() - t
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def measure(runs):
+    times = []
+    rss = []
+    for i in range(runs):
+        out = subprocess.check_output([sys.executable, "-c", PROBE])
+        elapsed, maxrss = out.split()
+        times.append(float(elapsed))
+        rss.append(int(maxrss))
+    times.sort()
+    return {
+        "benchmark": "startup",
+        "runs": runs,
+        "import_seconds_min": times[0],
+        "import_seconds_median": times[len(times) // 2],
+        "max_rss_kb": max(rss),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="diffengine start up time")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(measure(args.runs)))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+Measures how fast process_feed works through a synthetic corpus served
+from a local web server (see fixtures.py), at a few different sizes. The
+first round finds every article for the first time. In each round after
+that a change_rate fraction of the articles are edited, and every entry is
+made due again, so the diffing and rendering stages get exercised as well.
+
+Along with overall entries per second, the time spent in each stage is
+recorded. The stages are fetch, extract (readability and bleach),
+fingerprint, diff, render and db, and they overlap: db time is also
+counted in whichever stage made the query. extract and fingerprint are
+only seen when extract_workers is 0. Without phantomjs the render stage
+only covers handing the diff to a browser that does nothing, unless
+--renderer pillow is used to draw the images without a browser.
+
+The results are printed as JSON. They can be saved and compared with a
+later run, which exits non-zero if throughput drops by more than the
+tolerance:
+
+    % python benchmarks/throughput.py --sizes 10,1000 --output before.json
+    % python benchmarks/throughput.py --sizes 10,1000 --compare before.json
+"""
+
+import os
+import sys
+import json
+import time
+import yaml
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+
+from functools import wraps
+from datetime import datetime, timedelta
+
+# benchmark the working tree, not whatever happens to be installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import diffengine
+
+from fixtures import Corpus, serve
+
+
+class Stages(object):
+    """
+    Collects how long each call to the functions it wraps takes, by stage.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.lock = threading.Lock()
+        self.patched = []
+
+    def wrap(self, stage, owner, name):
+        original = getattr(owner, name)
+
+        @wraps(original)
+        def timed(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t
+                with self.lock:
+                    self.times.setdefault(stage, []).append(elapsed)
+
+        setattr(owner, name, timed)
+        self.patched.append((owner, name, original))
+
+    def unwrap(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+    def reset(self):
+        with self.lock:
+            self.times = {}
+
+    def summary(self):
+        with self.lock:
+            return dict((stage, _describe(times)) for stage, times in self.times.items())
+
+
+class NullBrowser(object):
+    """
+    Stands in for phantomjs when it isn't installed.
+    """
+
+    def set_window_size(self, width, height):
+        pass
+
+    def get(self, url):
+        pass
+
+    def execute_script(self, script):
+        return True
+
+    def save_screenshot(self, path):
+        pass
+
+    def quit(self):
+        pass
+
+
+def instrument(stages):
+    extract_module = sys.modules['diffengine.extract']
+    stages.wrap('fetch', diffengine.Entry, 'fetch')
+    stages.wrap('extract', extract_module, 'extract')
+    stages.wrap('fingerprint', extract_module, '_digest')
+    stages.wrap('diff', diffengine.Diff, 'generate_diff_html')
+    stages.wrap('render', diffengine.Diff, 'generate_diff_images')
+    stages.wrap('db', diffengine.db, 'execute_sql')
+
+
+def run(size, args):
+    corpus = Corpus(entries=size, per_feed=args.per_feed,
+                    change_rate=args.change_rate)
+    server, base_url = serve(corpus)
+    home = tempfile.mkdtemp(prefix="diffengine-bench-")
+    phantomjs = shutil.which(args.phantomjs)
+    config = {
+        "feeds": [{"name": "Feed %s" % f, "url": corpus.feed_url(f, base_url)}
+                  for f in range(corpus.feeds)],
+        "force_https": False,
+        "phantomjs": phantomjs or shutil.which("true"),
+        "budget": size,
+        "concurrency": args.concurrency,
+        "host_rate": 1000000,
+        "host_burst": 1000,
+        "extract_workers": args.extract_workers,
+        "render_workers": args.render_workers,
+        "storage": args.storage,
+        "renderer": args.renderer,
+    }
+    with open(os.path.join(home, "config.yaml"), "w") as fh:
+        yaml.dump(config, fh, default_flow_style=False)
+
+    results = []
+    stages = Stages()
+    try:
+        diffengine.init(home, prompt=False)
+        # at debug level writing the log would swamp everything else
+        logging.getLogger().setLevel(logging.WARNING)
+        if not phantomjs and diffengine.screenshots.pool:
+            diffengine.screenshots.pool.factory = NullBrowser
+        instrument(stages)
+
+        for r in range(args.rounds):
+            corpus.round = r
+            if r > 0:
+                (diffengine.Entry.update(next_check_at=datetime.utcnow() - timedelta(seconds=1))
+                    .execute())
+            versions = diffengine.EntryVersion.select().count()
+            diffs = diffengine.Diff.select().count()
+            stages.reset()
+
+            t = time.perf_counter()
+            checked = diffengine.process_feed()
+            elapsed = time.perf_counter() - t
+
+            results.append({
+                "entries": size,
+                "round": r,
+                "checked": checked,
+                "seconds": elapsed,
+                "entries_per_second": checked / elapsed if elapsed else None,
+                "new_versions": diffengine.EntryVersion.select().count() - versions,
+                "diffs": diffengine.Diff.select().count() - diffs,
+                "stages": stages.summary(),
+            })
+            logging.warning("%s entries, round %s: %.1fs", size, r, elapsed)
+    finally:
+        stages.unwrap()
+        diffengine.shutdown()
+        server.shutdown()
+        shutil.rmtree(home, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of the runs whose throughput dropped by more than
+    tolerance compared to the same size and round in the baseline.
+    """
+    before = dict(((r["entries"], r["round"]), r) for r in baseline["results"])
+    regressions = []
+    for r in results:
+        b = before.get((r["entries"], r["round"]))
+        if not b or not b["entries_per_second"] or not r["entries_per_second"]:
+            continue
+        change = r["entries_per_second"] / b["entries_per_second"] - 1
+        if change < -tolerance:
+            regressions.append({"entries": r["entries"], "round": r["round"],
+                                "before": b["entries_per_second"],
+                                "after": r["entries_per_second"],
+                                "change": change})
+    return regressions
+
+
+def _describe(times):
+    times = sorted(times)
+    n = len(times)
+    return {
+        "count": n,
+        "total": sum(times),
+        "mean": sum(times) / n,
+        "p50": times[n // 2],
+        "p95": times[min(int(n * 0.95), n - 1)],
+        "max": times[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="diffengine throughput")
+    parser.add_argument("--sizes", default="10,1000",
+                        help="comma separated numbers of entries, e.g. 10,1000,100000")
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--change-rate", type=float, default=0.1)
+    parser.add_argument("--per-feed", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--extract-workers", type=int, default=0)
+    parser.add_argument("--render-workers", type=int, default=2)
+    parser.add_argument("--storage", default="full", choices=["full", "delta"])
+    parser.add_argument("--phantomjs", default="phantomjs")
+    parser.add_argument("--renderer", default="phantomjs", choices=["phantomjs", "pillow"])
+    parser.add_argument("--output", help="write the results here as well")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fractional drop in throughput to report")
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        results.extend(run(size, args))
+
+    report = {
+        "benchmark": "throughput",
+        "created": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": vars(args),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "results": results,
+    }
+    if args.compare:
+        with open(args.compare) as fh:
+            report["regressions"] = compare(results, json.load(fh), args.tolerance)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(output)
+    print(output)
+
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
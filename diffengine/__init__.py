@@ -3,38 +3,103 @@
 
 # maybe this module should be broken up into multiple files, or maybe not ...
 
+# heavy dependencies (requests, selenium, tweepy, jinja2, feedparser,
+# readability, htmldiff) are imported by the code that needs them, which
+# keeps start up quick for cron runs and anything else that imports this
+
 UA = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/63.0.3239.84 Safari/537.36"
 # """diffengine/0.1.2 (+https://github.com/docnow/diffengine)"
 
 import os
-import re
 import sys
 import time
+import json
+import glob
 import yaml
-import bleach
 import codecs
-import jinja2
-import tweepy
+import socket
+import hashlib
+import calendar
+import functools
+import itertools
 import logging
-import htmldiff
-import requests
-import feedparser
+import tempfile
 import subprocess
-import readability
-import unicodedata
+import atexit
 import argparse
 
 from peewee import *
-from datetime import datetime
-from selenium import webdriver
+from datetime import datetime, timedelta
+from multiprocessing import get_context
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from diffengine import delta, metrics, paragraphs, render, scheduling
+from diffengine import exclude as exclusions
+from diffengine.artifacts import ArtifactStore, EXTENSIONS, encode
+from diffengine.browser import BrowserPool, ScreenshotQueue
+from diffengine.daemon import Daemon
+from diffengine.outbox import Outbox, RateLimited, retry_after
+from diffengine.feeds import FeedReader
+from diffengine.extract import Extractor, ExtractionTimeout, extract, _normal, _equal, _fingerprint, _digest
+from diffengine.session import Session
+from diffengine.throttle import HostThrottle
+from diffengine.warc import WarcWriter, WarcArchive, tee
 from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
 from argparse import RawTextHelpFormatter
 
 home = None
 config = {}
-db = SqliteDatabase(None)
+
+
+class TimedSqliteDatabase(SqliteDatabase):
+    """
+    Records how long each query takes, by the kind of statement.
+    """
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        statement = sql.split(None, 1)[0].upper() if sql else ""
+        with metrics.timer(metrics.db_seconds, statement=statement):
+            return super(TimedSqliteDatabase, self).execute_sql(sql, params, require_commit)
+
+
+# WAL lets readers like a web ui or an exporter work alongside a run
+# without getting "database is locked", and with WAL a synchronous of
+# NORMAL is still safe against corruption
+db = TimedSqliteDatabase(None, pragmas=(
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('cache_size', -32000),
+    ('temp_store', 'memory'),
+))
+throttle = HostThrottle()
+session = None
+# the outbox retries jobs itself, so its requests aren't retried on status
+outbox_session = None
+screenshots = ScreenshotQueue(BrowserPool(), workers=0)
+extractor = Extractor()
+# authenticated tweepy clients, keyed by consumer key and access token
+twitter_clients = {}
+# (index, count) when this process is one of several sharing the work
+shard = None
+# serves the metrics over http when metrics_port is set
+metrics_server = None
+# captures what is fetched when warc_dir is set
+warc = None
+# keeps the html and images of diffs when artifact_store is on
+artifact_store = None
+# what has been learned about when edits happen, when scheduler is adaptive
+edit_model = None
+learned_at = 0
+# who holds the leases taken by this process
+lease_owner = "%s:%s" % (socket.gethostname(), os.getpid())
 
 trace_output = False
+
+# entries are checked again once the time since their last check is this
+# fraction of their age, but not within min_wait seconds of the last check,
+# and not at all once they are older than max_age
+stale_ratio = 0.2
+min_wait = 60
+max_age = 2628000
 screenshot_suffix = ".jpg"
 thumbnail_suffix = "-thumb" + screenshot_suffix
 
@@ -44,13 +109,34 @@ class BaseModel(Model):
         database = db
 
 
-class Feed(BaseModel):
+class Fetchable(BaseModel):
+    """
+    Remembers the validators from the last successful fetch of a resource so
+    that the next fetch can be made conditional.
+    """
+    etag = CharField(null=True)
+    last_modified = CharField(null=True)
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class Feed(Fetchable):
     url = CharField(primary_key=True)
     name = CharField()
     created = DateTimeField(default=datetime.utcnow)
 
     @staticmethod
     def sanitize_url(url):
+        # force_https can be turned off for feeds served locally, like the
+        # fixtures that the benchmarks use
+        if not config.get('force_https', True):
+            return url
         return url.replace('http://', 'https://')
 
     @property
@@ -61,51 +147,131 @@ class Feed(BaseModel):
                 .where(Feed.url==self.url)
                 .order_by(Entry.created.desc()))
 
-    def refresh_feed(self):
+    def refresh_feed(self, max_items=None):
         """
-        Gets the feed and creates new entries for new content. The number
-        of new entries created will be returned.
+        Gets the feed and creates new entries for new content. The feed is
+        read as it downloads, feed_batch items at a time, and reading stops
+        at the first batch with nothing new in it, or after max_items items.
+        Sitemaps aren't necessarily newest first, so they are always read
+        up to max_items. The number of new entries created will be returned.
         """
+        max_items = max_items or config.get('feed_max_items', 5000)
+        batch_size = config.get('feed_batch', 100)
         logging.info("fetching feed: %s", self.url)
         try:
-            resp = _get(self.url)
-            feed = feedparser.parse(resp.text)
+            # the body is read a bit at a time below
+            resp = _get(self.url, headers=self.conditional_headers(), stream=True)
         except Exception as e:
             logging.error("unable to fetch feed %s: %s", self.url, e)
             return 0
-        count = 0
-        dupe_count = 0
-        dupe_table = []
-        for feed_entry in feed.entries:
-            # note: look up with url only, because there may be 
-            # overlap bewteen feeds, especially when a large newspaper
-            # has multiple feeds
-            s_url = Feed.sanitize_url(feed_entry.link)
-            entry, created = Entry.get_or_create(url=s_url)
-
-            if entry in dupe_table:
-                dupe_count += 1
-            else:
-                dupe_table.append(entry)
 
-                if created:
-                    FeedEntry.create(entry=entry, feed=self)
-                    logging.info("found new entry: %s", feed_entry.link)
-                    count += 1
-                elif len(entry.feeds.where(Feed.url == self.url)) == 0:
-                    FeedEntry.create(entry=entry, feed=self)
-                    logging.debug("found entry from another feed: %s", feed_entry.link)
-                    count += 1
+        count = total = dupe_count = 0
+        reader = capture = None
+        try:
+            if resp.status_code == 304:
+                logging.info("feed hasn't changed: %s", self.url)
+                return 0
+            if resp.status_code != 200:
+                logging.error("got %s when fetching feed %s", resp.status_code, self.url)
+                return 0
+            chunks = resp.iter_content(64 * 1024)
+            if warc:
+                capture = tempfile.SpooledTemporaryFile(1024 * 1024)
+                chunks = tee(chunks, capture)
+            reader = FeedReader(chunks, config.get('max_response_size', 10 * 1024 * 1024))
+            links = iter(reader)
+            seen = set()
+            while total < max_items:
+                urls = []
+                size = min(batch_size, max_items - total)
+                n = 0
+                for link in itertools.islice(links, size):
+                    n += 1
+                    # note: look up with url only, because there may be 
+                    # overlap bewteen feeds, especially when a large newspaper
+                    # has multiple feeds
+                    s_url = Feed.sanitize_url(link)
+                    if s_url in seen:
+                        dupe_count += 1
+                    else:
+                        seen.add(s_url)
+                        urls.append(s_url)
+                total += n
+                new = self.add_entries(urls)
+                count += new
+                if n < size:
+                    break
+                if new == 0 and reader.kind != 'sitemap':
+                    logging.info("stopped reading %s at items already seen", self.url)
+                    break
+            else:
+                logging.info("stopped reading %s after %s items", self.url, total)
+        except Exception as e:
+            logging.error("unable to read feed %s: %s", self.url, e)
+            return count
+        finally:
+            resp.close()
+            if warc:
+                _capture(resp, capture, truncated=reader is not None and not reader.complete)
 
         if dupe_count > 0:
-            logging.info('Found duplicates in the feed, %s', str(dupe_table))
-        return count
+            logging.info('Found %s duplicates in the feed %s', dupe_count, self.url)
 
+        metrics.http_bytes.observe(reader.size, host=urlparse(self.url).netloc)
+        self.etag = resp.headers.get("ETag")
+        self.last_modified = resp.headers.get("Last-Modified")
+        self.save()
+        return count
 
-class Entry(BaseModel):
-    url = CharField()
+    def add_entries(self, urls):
+        """
+        Makes sure there is an Entry for each url and that each of them
+        belongs to this feed. Existing entries and feed memberships are
+        looked up with IN queries, and the missing rows are inserted in
+        bulk inside one transaction. The number of entries that were new
+        to the feed is returned.
+        """
+        # IMMEDIATE so that shards adding the same urls take turns,
+        # instead of one failing when it goes from reading to writing
+        with db.atomic('IMMEDIATE'):
+            entries = Entry.ids_for(urls)
+            new_urls = [url for url in urls if url not in entries]
+            for chunk in _chunks(new_urls, 100):
+                Entry.insert_many([{'url': url} for url in chunk]).execute()
+            for url in new_urls:
+                logging.info("found new entry: %s", url)
+            entries.update(Entry.ids_for(new_urls))
+
+            in_feed = set()
+            for chunk in _chunks(list(entries.values()), 500):
+                query = (FeedEntry.select(FeedEntry.entry)
+                         .where(FeedEntry.feed == self.url, FeedEntry.entry << chunk)
+                         .tuples())
+                for (entry_id,) in query:
+                    in_feed.add(entry_id)
+
+            new_urls = set(new_urls)
+            rows = []
+            for url in urls:
+                if entries[url] in in_feed:
+                    continue
+                if url not in new_urls:
+                    logging.debug("found entry from another feed: %s", url)
+                rows.append({'feed': self.url, 'entry': entries[url]})
+            for chunk in _chunks(rows, 100):
+                FeedEntry.insert_many(chunk).execute()
+
+        return len(rows)
+
+
+class Entry(Fetchable):
+    url = CharField(index=True)
     created = DateTimeField(default=datetime.utcnow)
     checked = DateTimeField(default=datetime.utcnow)
+    next_check_at = DateTimeField(default=datetime.utcnow, null=True, index=True)
+    # the sha1 of the last page fetched, so that an identical page can be
+    # spotted without having to parse it again
+    content_hash = CharField(null=True)
 
     @property
     def feeds(self):
@@ -114,76 +280,151 @@ class Entry(BaseModel):
                 .join(Entry)
                 .where(Entry.id==self.id))
 
-    @property   
-    def stale(self):
-        """
-        A heuristic for checking new content very often, and checking 
-        older content less frequently. If an entry is deemed stale then
-        it is worth checking again to see if the content has changed.
-        """
-
-        # never been checked before it's obviously stale
-        if not self.checked:
+    def unchanged(self, resp):
+        if resp.status_code == 304:
             return True
+        return self.content_hash is not None and \
+            self.content_hash == _content_hash(resp.content)
 
-        # time since the entry was created
-        hotness = (datetime.utcnow() - self.created).seconds
-        if hotness == 0:
-            return True
+    def remember(self, resp):
+        if resp.status_code != 200:
+            return
+        self.etag = resp.headers.get("ETag")
+        self.last_modified = resp.headers.get("Last-Modified")
+        self.content_hash = _content_hash(resp.content)
 
-        # don't bother checking if it's older than 1 month
-        if hotness - 2628000 > 0:
-            logging.debug("%s is older than 1 month, excluding", self.url)
-            return False
+    @staticmethod
+    def ids_for(urls):
+        """
+        Returns a dictionary of url to entry id for the urls that already
+        have an entry, using the oldest entry if a url has more than one.
+        """
+        ids = {}
+        for chunk in _chunks(urls, 500):
+            query = (Entry.select(Entry.url, Entry.id)
+                     .where(Entry.url << chunk)
+                     .order_by(Entry.id)
+                     .tuples())
+            for url, entry_id in query:
+                ids.setdefault(url, entry_id)
+        return ids
+
+    def schedule(self):
+        """
+        Works out when the entry is next due to be checked. It is due again
+        once the time since it was checked reaches stale_ratio of its age,
+        so that new content is checked often and older content less so.
+        Solving that for the time gives checked + age * ratio / (1 - ratio),
+        which is kept to at least min_wait so that brand new entries aren't
+        fetched over and over by a daemon that is always running. Entries
+        that would be older than max_age by then are never checked again,
+        which is recorded as a null next_check_at. When there is an
+        edit_model the wait comes from what it has learned about the entry's
+        feed and host.
+        """
+        age = (self.checked - self.created).total_seconds()
+        if edit_model:
+            wait = edit_model.wait(age, *self.schedule_keys())
+        else:
+            wait = max(age * stale_ratio / (1 - stale_ratio), min_wait)
+        if wait is None or age + wait > max_age:
+            self.next_check_at = None
+        else:
+            self.next_check_at = self.checked + timedelta(seconds=wait)
+        return self.next_check_at
+
+    def schedule_keys(self):
+        # due_entries looks up a feed along with the entry
+        feed_url = getattr(self, 'feed_url', None)
+        if feed_url is None:
+            feed_url = (FeedEntry.select(fn.MIN(FeedEntry.feed))
+                        .where(FeedEntry.entry == self.id)
+                        .scalar())
+        return _schedule_keys(self.url, feed_url)
+
+    def mark_checked(self):
+        self.checked = datetime.utcnow()
+        self.schedule()
+        self.save()
 
-        # time since the entry was last checked
-        staleness = (datetime.utcnow() - self.checked).seconds
+    def fetch(self):
+        """
+        Gets the current version of the entry from the web. The per-host
+        throttle is waited on first so that concurrent checks stay polite.
+        None is returned if the page couldn't be fetched.
+        """
 
-        # ratio of staleness to hotness
-        r = staleness / float(hotness)
+        # make sure we don't go too fast
+        throttle.wait(self.url)
 
-        # TODO: allow this magic number to be configured per feed?
-        if r >= 0.2:
-            logging.debug("%s is stale (r=%f)", self.url, r)
-            return True
+        logging.info("checking %s", self.url)
+        try:
+            resp = _get(self.url, headers=self.conditional_headers())
+        except Exception as e:
+            logging.error("unable to fetch %s: %s", self.url, e)
+            return None
+        if warc:
+            _capture(resp)
 
-        logging.debug("%s not stale (r=%f)", self.url, r)
-        return False
+        if resp.status_code not in (200, 304):
+            logging.warning("Got %s when fetching %s", resp.status_code, self.url)
+            return None
 
-    def get_latest(self, archive_enabled):
+        return resp
+
+    def hurry_copies(self, version):
+        """
+        Makes the other entries that have had the same content as version
+        due now, since whatever changed here has probably changed there too.
+        When they are checked the new version and diff are shared, not
+        stored and rendered again.
+        """
+        key = version.same_as or version.id
+        copies = (EntryVersion.select(EntryVersion.entry)
+                  .where((EntryVersion.id == key) | (EntryVersion.same_as == key),
+                         EntryVersion.entry != self.id))
+        now = datetime.utcnow()
+        n = (Entry.update(next_check_at=now)
+             .where(Entry.id << copies, Entry.next_check_at > now)
+             .execute())
+        if n:
+            logging.info("checking %s copies of %s sooner", n, self.url)
+        return n
+
+    def get_latest(self, archive_enabled, resp=None, extracted=None, exclude=None):
         """
         get_latest is the heart of the application. It will get the current 
         version on the web, extract its summary with readability and compare 
         it against a previous version. If a difference is found it will 
-        compute the diff, save it as html and png files, and tell Internet 
-        Archive to create a snapshot.
+        compute the diff, save it as html and png files, and queue up a job
+        for Internet Archive to create a snapshot.
+
+        A response that has already been fetched with fetch() can be passed
+        in, otherwise the page is fetched here. Likewise the (title, summary,
+        fingerprint) that extract() got from the response can be passed in
+        if it has already been run. exclude is the feed's compiled exclusion
+        pattern, see diffengine.exclude.
 
         If a new version was found it will be returned, otherwise None will
         be returned.
         """
 
-        # make sure we don't go too fast
-        time.sleep(1)
-
-        # fetch the current readability-ized content for the page
-        logging.info("checking %s", self.url)
-        try:
-            resp = _get(self.url)
-        except Exception as e:
-            logging.error("unable to fetch %s: %s", self.url, e)
+        if resp is None:
+            resp = self.fetch()
+        if resp is None:
             return None
 
-        if resp.status_code != 200:
-            logging.warning("Got %s when fetching %s", resp.status_code, self.url)
+        # a 304 or the exact same bytes as last time can't have changed
+        if self.unchanged(resp):
+            logging.debug("content hasn't changed %s", self.url)
+            self.mark_checked()
             return None
 
         if trace_output:
             logging.debug("-- Trace response text from %s\n\n%s", self.url, resp.text)
-        doc = readability.Document(resp.text)
-        title = doc.title()
-        summary = doc.summary(html_partial=True)
-        summary = bleach.clean(summary, tags=["p"], strip=True)
-        summary = _normal(summary)
+        if extracted is None:
+            extracted = extract(resp.text, exclude=exclude)
+        title, summary, fingerprint = extracted
         logging.debug("Response processed for entry %s", self.id)
         # in case there was a redirect, and remove utm style marketing
         canonical_url = _remove_utm(resp.url)
@@ -193,41 +434,60 @@ class Entry(BaseModel):
                           self.url, canonical_url, resp.status_code)
 
         # get the latest version, if we have one
-        versions = EntryVersion.select().where(EntryVersion.url==canonical_url)
-        versions = versions.order_by(-EntryVersion.created)
-        if len(versions) == 0:
-            old = None
-        else:
-            old = versions[0]
+        old = (EntryVersion.select()
+               .where(EntryVersion.url==canonical_url)
+               .order_by(-EntryVersion.created)
+               .first())
 
         # compare what we got against the latest version and create a 
         # new version if it looks different, or is brand new (no old version)
         new = None
 
-        # use _equal to determine if the summaries are the same
-        if not old or old.title != title or not _equal(old.summary, summary):
-            new = EntryVersion.create(
+        # compare fingerprint digests to determine if the summaries are the
+        # same, which saves normalizing and bleaching the old summary again
+        changed = not old or old.title != title or old.digest() != fingerprint
+
+        # versions saved before an exclusion rule was added still have the
+        # text that it takes out, which shouldn't count as a change either
+        if changed and old and old.title == title and exclude is not None:
+            changed = _digest(exclusions.apply(exclude, old.summary)) != fingerprint
+
+        if changed:
+            new = EntryVersion(
                 title=title,
                 url=canonical_url,
                 summary=summary,
+                fingerprint=fingerprint,
                 entry=self
             )
-            if archive_enabled:
-                new.archive()
+            dedupe = config.get('dedupe', True)
+            if dedupe and new.share():
+                logging.debug("sharing summary of version %s", new.same_as)
+            elif old and config.get('storage') == 'delta':
+                new.delta_from(old, config.get('keyframe_interval', 10))
+            new.save()
             if old:
                 logging.debug("found new version %s", old.entry.url)
                 diff = Diff.create(old=old, new=new)
-                if not diff.generate(None):
+                if not diff.generate(None, exclude):
                     logging.warning("html diff showed no changes: %s", self.url)
-                    new.delete()
+                    with db.atomic():
+                        diff.delete_instance()
+                        new.delete_instance()
                     new = None
+                elif dedupe and diff.same_as is None:
+                    # the first of the copies to change
+                    self.hurry_copies(old)
             else:
                 logging.debug("found first version: %s", self.url)
+            # archiving is slow, so it is left to the outbox
+            if new and archive_enabled:
+                outbox.put('archive', version=new)
         else:
             logging.debug("content hasn't changed %s", self.url)
 
-        self.checked = datetime.utcnow()
-        self.save()
+        self.remember(resp)
+        self.mark_checked()
 
         return new
 
@@ -237,14 +497,142 @@ class FeedEntry(BaseModel):
     entry = ForeignKeyField(Entry)
     created = DateTimeField(default=datetime.utcnow)
 
+    class Meta:
+        indexes = (
+            (('feed', 'entry'), True),
+        )
+
+    @staticmethod
+    def remove_duplicates():
+        """
+        Deletes all but the first row for each feed and entry pair, which
+        older versions of diffengine could create.
+        """
+        first = (FeedEntry.select(fn.MIN(FeedEntry.id))
+                 .group_by(FeedEntry.feed, FeedEntry.entry))
+        count = FeedEntry.delete().where(~(FeedEntry.id << first)).execute()
+        if count:
+            logging.info("removed %s duplicate feed entries", count)
+
 
 class EntryVersion(BaseModel):
     title = CharField()
     url = CharField()
-    summary = CharField()
+    # the full summary, or empty when the version is stored as a delta
+    stored_summary = CharField(db_column='summary')
     created = DateTimeField(default=datetime.utcnow)
     archive_url = CharField(null=True)
     entry = ForeignKeyField(Entry, related_name='versions')
+    fingerprint = CharField(null=True, index=True)
+    # the id of the version the delta applies to, and how many deltas
+    # away from a full copy of the summary this version is
+    delta = BlobField(null=True)
+    delta_base = IntegerField(null=True, index=True)
+    chain = IntegerField(default=0)
+    # the id of a version, usually of another entry, with exactly the same
+    # title and summary, whose stored summary this version uses
+    same_as = IntegerField(null=True, index=True)
+
+    class Meta:
+        indexes = (
+            # latest version for a url, and the versions of an entry
+            (('url', 'created'), False),
+            (('entry', 'created'), False),
+        )
+
+    _summary = None
+    _summary_changed = False
+
+    @property
+    def summary(self):
+        """
+        The full text of the summary. Versions stored as deltas are rebuilt
+        from their keyframe, which is never more than keyframe_interval
+        versions away, and shared ones come from the version they share.
+        """
+        if self._summary is None:
+            if self.same_as is not None:
+                self._summary = EntryVersion.get(EntryVersion.id == self.same_as).summary
+            elif self.delta is None:
+                self._summary = self.stored_summary
+            else:
+                base = EntryVersion.get(EntryVersion.id == self.delta_base)
+                self._summary = delta.apply(base.summary, self.delta)
+        return self._summary
+
+    @summary.setter
+    def summary(self, value):
+        self._summary = value
+        self._summary_changed = True
+        self.stored_summary = value
+        self.delta = None
+        self.delta_base = None
+        self.same_as = None
+        self.chain = 0
+
+    def share(self):
+        """
+        Stores the summary as a reference to an earlier version with the
+        same title and summary, which is often the same wire story in
+        another feed, rather than keeping another copy of it. The lookup
+        goes by fingerprint, and the summaries are then compared exactly,
+        since fingerprints ignore punctuation.
+        """
+        summary = self.summary
+        candidates = (EntryVersion.select()
+                      .where(EntryVersion.fingerprint == _digest(summary),
+                             EntryVersion.title == self.title,
+                             EntryVersion.same_as >> None)
+                      .order_by(EntryVersion.id)
+                      .limit(5))
+        for original in candidates:
+            if original.summary == summary:
+                self.same_as = original.id
+                self.chain = original.chain
+                self.stored_summary = ''
+                return True
+        return False
+
+    def delta_from(self, previous, keyframe_interval=10):
+        """
+        Stores the summary as a delta against the previous version, unless
+        the chain of deltas back to a keyframe would get too long or the
+        delta isn't any smaller, in which case the full summary is kept.
+        """
+        if previous.chain + 1 >= keyframe_interval:
+            return False
+        summary = self.summary
+        d = delta.encode(previous.summary, summary)
+        if len(d) >= len(summary.encode('utf8')):
+            return False
+        self.delta = d
+        self.delta_base = previous.id
+        self.chain = previous.chain + 1
+        self.stored_summary = ''
+        return True
+
+    def digest(self):
+        """
+        The digest of the summary's fingerprint. Versions saved before the
+        fingerprint column existed have it worked out on the fly.
+        """
+        return self.fingerprint or _digest(self.summary)
+
+    def save(self, *args, **kwargs):
+        if self._summary_changed:
+            # keep the fingerprint in step when the summary is changed
+            if 'fingerprint' not in self._dirty:
+                self.fingerprint = _digest(self.summary)
+            # versions stored as deltas against this one need their own
+            # copy of the summary before this one changes underneath them
+            if self.id is not None:
+                dependents = EntryVersion.select().where(
+                    (EntryVersion.delta_base == self.id) | (EntryVersion.same_as == self.id))
+                for version in list(dependents):
+                    version.summary = version.summary
+                    version.save()
+            self._summary_changed = False
+        return super(EntryVersion, self).save(*args, **kwargs)
 
     @property
     def diff(self):
@@ -274,45 +662,81 @@ class EntryVersion(BaseModel):
         return "<h1>%s</h1>\n\n%s" % (self.title, self.summary)
 
     def archive(self):
-        save_url = "https://web.archive.org/save/" + self.url
-        try:
-            resp = _get(save_url)
-            wayback_id = resp.headers.get("Content-Location")
-            if wayback_id:
-                self.archive_url = "https://wayback.archive.org" + wayback_id
-                logging.debug("archived version at %s", self.archive_url)
-                self.save()
-                return self.archive_url
-            else:
-                logging.error("unable to get archive id from %s: %s",
-                        self.archive_url, resp.headers)
+        """
+        Asks the Wayback Machine to take a snapshot of the version's url and
+        returns the snapshot's url. RateLimited is raised if it asks us to
+        slow down, and ArchiveFailed if no snapshot was made.
+        """
+        save_url = config.get('wayback_url', "https://web.archive.org/save/") + self.url
+        resp = _get(save_url, retry_status=False)
+        if resp.status_code == 429:
+            raise RateLimited(retry_after(resp.headers.get("Retry-After")))
+        wayback_id = resp.headers.get("Content-Location")
+        if not wayback_id:
+            raise ArchiveFailed("unable to get archive id from %s: %s %s" %
+                                (save_url, resp.status_code, resp.headers))
+        self.archive_url = "https://wayback.archive.org" + wayback_id
+        logging.debug("archived version at %s", self.archive_url)
+        self.save(only=[EntryVersion.archive_url])
+        return self.archive_url
 
-        except Exception as e:
-            logging.error("unexpected archive.org response for %s: %s", save_url, e)
-        return None
+
+class ArchiveFailed(Exception):
+    pass
 
 
 class Diff(BaseModel):
-    old = ForeignKeyField(EntryVersion, related_name="prev_diffs")
-    new = ForeignKeyField(EntryVersion, related_name="next_diffs")
+    old = ForeignKeyField(EntryVersion, related_name="prev_diffs", index=True)
+    new = ForeignKeyField(EntryVersion, related_name="next_diffs", index=True)
     created = DateTimeField(default=datetime.utcnow)
     tweeted = DateTimeField(null=True)
     blogged = DateTimeField(null=True)
+    # the id of an earlier diff between the same content, whose html and
+    # images this diff uses rather than rendering its own
+    same_as = IntegerField(null=True, index=True)
 
     def html_path(self):
-        # use prime number to spread across directories
+        if self.same_as is not None:
+            return Diff.get(Diff.id == self.same_as).html_path()
+        if artifact_store:
+            stored = self.artifact_path('html')
+            if stored:
+                return stored
+        return self.work_path()
+
+    def work_path(self):
+        # where the diff is rendered, and kept if there's no artifact store
         created_day = self.created.strftime('%Y-%m-%d')
-        path = home_path("diffs/%s/%s.html" % (created_day, self.id))
-        if not os.path.isdir(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
-        return path
+        return home_path("diffs/%s/%s.html" % (created_day, self.id))
+
+    def artifact_path(self, kind):
+        """
+        Returns where the html, screenshot or thumbnail of the diff is in
+        the artifact store, going by the index alone, or None if it isn't
+        there.
+        """
+        artifact = (Artifact.select(Artifact.digest, Artifact.ext)
+                    .where(Artifact.diff == (self.same_as or self.id),
+                           Artifact.kind == kind)
+                    .first())
+        if artifact is None:
+            return None
+        return artifact_store.path(artifact.digest, artifact.ext)
 
     def screenshot_path(self, path=None):
+        if not path and artifact_store:
+            path = self.artifact_path('screenshot')
+            if path:
+                return path
         if not path:
             path = self.html_path()
         return path.replace(".html", screenshot_suffix)
 
     def thumbnail_path(self, path=None):
+        if not path and artifact_store:
+            path = self.artifact_path('thumbnail')
+            if path:
+                return path
         if not path:
             path = self.html_path()
 
@@ -323,70 +747,87 @@ class Diff(BaseModel):
         else:
             return path.join(thumbnail_suffix)
 
-    def generate(self, path=None):
+    def share(self):
+        """
+        Points the diff at an earlier diff between versions that share
+        their content with this one's, if there is one, so that it doesn't
+        have to be rendered again.
+        """
+        old = self.old.same_as or self.old.id
+        new = self.new.same_as or self.new.id
+        original = (Diff.select(Diff.id)
+                    .where(Diff.old << _copies(old), Diff.new << _copies(new),
+                           Diff.same_as >> None, Diff.id != self.id)
+                    .order_by(Diff.id)
+                    .first())
+        if original is None:
+            return False
+        self.same_as = original.id
+        self.save(only=[Diff.same_as])
+        return True
+
+    def generate(self, path=None, exclude=None):
+        if path is None and config.get('dedupe', True) and self.share():
+            logging.debug("diff %s uses the html and images of diff %s",
+                          self.id, self.same_as)
+            return True
         if not path:
-            path = self.html_path()
-        html = self.generate_diff_html(path)
+            path = self.work_path()
+        html = self.generate_diff_html(path, exclude)
         if html:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
             codecs.open(path, "w", 'utf8').write(html)
-            self.generate_diff_images(path)
+            screenshots.submit(self, path)
             return True
         else:
             logging.error("Failed to generate diff for %s", path)
             return False
 
-    ins_diff_exclusions = ["<ins>\* Comments",
-                       "<ins>Comments",]
-
-    del_diff_exclusions = ["<del>\* Comments",
-                          "<del>Comments",
-                          "Last updated <del>",]
-
     def validate_diff(self, diff):
         if '<ins>' not in diff and '<del>' not in diff:
             logging.debug('No change found')
             return False
-
-        logging.info("Diff found, checking exclusions")
-        ins_count = len(re.findall("<ins>", diff))
-        del_count = len(re.findall("<del>", diff))
-        ins_exclusion_count = 0
-        del_exclusion_count = 0
-
-        for exclusion in self.ins_diff_exclusions:
-            result = len(re.findall(exclusion, diff))
-            ins_exclusion_count += result
-            if result > 0:
-                logging.debug('Matched insert exclusion: %s', exclusion)
-        for exclusion in self.del_diff_exclusions:
-            result = len(re.findall(exclusion, diff))
-            del_exclusion_count += result
-            if result > 0:
-                logging.debug('Matched delete exclusion: %s', exclusion)
-
-        if ins_count == ins_exclusion_count and del_count == del_exclusion_count:
-            logging.info('Ignoring diff due to exclusion count, (ins: %s, del: %s)', ins_exclusion_count, del_exclusion_count)
-            return False
-
         return True
 
-    def generate_diff_html(self, path):
-        if os.path.isfile(path):
-            logging.error("Diff file already exists: %s", path)
+    def render_diff(self, exclude=None):
+        """
+        Returns the html diff of the old and new versions, or None if there
+        are no changes. By default only the paragraphs that changed are word
+        diffed, and they are checked for changes before the rest of the diff
+        is put together. Setting diff_engine to htmldiff diffs the whole of
+        both versions. A compiled exclude pattern is applied to both
+        versions first, for diffs saved before their feed's rules changed.
+        """
+        old_html, new_html = self.old.html, self.new.html
+        if exclude is not None:
+            old_html = exclusions.apply(exclude, old_html)
+            new_html = exclusions.apply(exclude, new_html)
+
+        if config.get('diff_engine', 'paragraph') == 'htmldiff':
+            import htmldiff
+            diff = htmldiff.render_html_diff(old_html, new_html)
+            return diff if self.validate_diff(diff) else None
+
+        changes = paragraphs.compare(old_html, new_html)
+        if not changes.changed:
+            logging.debug('No change found')
+            return None
+        if not self.validate_diff(''.join(changes.rendered_changes())):
             return None
+        return changes.render()
 
-        tmpl_path = os.path.join(os.path.dirname(__file__), "diff_template.html")
-        if not os.path.isfile(tmpl_path):
-            logging.error("Failed to find diff template: %s", tmpl_path)
+    def generate_diff_html(self, path, exclude=None):
+        if os.path.isfile(path):
+            logging.error("Diff file already exists: %s", path)
             return None
 
         logging.debug("creating html diff: %s", path)
-        diff = htmldiff.render_html_diff(self.old.html, self.new.html)
-        if not self.validate_diff(diff):
+        with metrics.timer(metrics.diff_seconds):
+            diff = self.render_diff(exclude)
+        if diff is None:
             return None
 
-        tmpl = jinja2.Template(codecs.open(tmpl_path, "r", "utf8").read())
-        html = tmpl.render(
+        html = render.page(
             title=self.new.title,
             url=self.old.entry.url,
             old_time=self.old.created,
@@ -395,26 +836,196 @@ class Diff(BaseModel):
         )
         return html
 
-    def generate_diff_images(self, html_path):
+    def generate_diff_images(self, html_path, browser=None):
         if os.path.isfile(self.screenshot_path(html_path)):
             logging.error("Screenshot already exists at path: %s", html_path)
             return
-        if not hasattr(self, 'browser'):
-            phantomjs = config.get('phantomjs', 'phantomjs')
-            self.browser = webdriver.PhantomJS(phantomjs)
+        if browser is None and config.get('renderer') != 'pillow':
+            with screenshots.pool.browser() as browser:
+                return self.generate_diff_images(html_path, browser)
+
+        if config.get('renderer') == 'pillow':
+            with metrics.timer(metrics.screenshot_seconds):
+                logging.debug("drawing images for %s", html_path)
+                render.draw_diff(html_path, self.screenshot_path(html_path),
+                                 self.thumbnail_path(html_path),
+                                 render.load_font(config.get('render_font')))
+        else:
+            self.take_screenshots(html_path, browser)
+
+        # diffs rendered anywhere else are being rerun or rerendered
+        if artifact_store and html_path == self.work_path():
+            self.store_artifacts(html_path)
+
+    def take_screenshots(self, html_path, browser):
+        with metrics.timer(metrics.screenshot_seconds):
+            screenshot = self.screenshot_path(html_path)
+            logging.debug("creating image screenshot %s", screenshot)
+            browser.set_window_size(1400, 1000)
+            browser.get(html_path)
+            _wait_for_page(browser, html_path)
+            browser.save_screenshot(screenshot)
+
+            thumbnail = self.thumbnail_path(html_path)
+            logging.debug("creating image thumbnail %s", thumbnail)
+            browser.set_window_size(800, 400)
+            browser.execute_script("clip()")
+            browser.save_screenshot(thumbnail)
+
+    def store_artifacts(self, html_path):
+        """
+        Moves the html and images rendered at html_path into the artifact
+        store, with the images re-encoded as image_format, and records them
+        in the index in place of any that the diff had before. When a diff
+        with the same html, this one included, has images already, they are
+        used rather than storing new copies, since PhantomJS doesn't always
+        render the same page to the same bytes.
+        """
+        fmt = config.get('image_format', 'jpeg')
+        quality = config.get('image_quality', 80)
+        paths = [html_path, self.screenshot_path(html_path), self.thumbnail_path(html_path)]
+        with open(html_path, 'rb') as fh:
+            html = fh.read()
+        screenshot = encode(paths[1], fmt, quality)
+        thumbnail = encode(paths[2], fmt, quality)
+
+        rows = [dict(diff=self.id, kind='html', ext='.html', size=len(html),
+                     digest=artifact_store.put(html, '.html'))]
+        html_digest = rows[0]['digest']
+        twins = (Artifact.select(Artifact.diff)
+                 .where(Artifact.kind == 'html', Artifact.digest == html_digest))
+        twin = (Artifact.select(Artifact.diff)
+                .where(Artifact.diff << twins, Artifact.kind == 'thumbnail')
+                .first())
+        if twin:
+            logging.debug("diff %s uses the images of diff %s", self.id, twin.diff_id)
+            for a in Artifact.select().where(Artifact.diff == twin.diff_id,
+                                             Artifact.kind != 'html'):
+                rows.append(dict(diff=self.id, kind=a.kind, ext=a.ext, size=a.size,
+                                 digest=a.digest))
+        else:
+            ext = EXTENSIONS[fmt]
+            rows.append(dict(diff=self.id, kind='screenshot', ext=ext, size=len(screenshot),
+                             digest=artifact_store.put(screenshot, ext)))
+            rows.append(dict(diff=self.id, kind='thumbnail', ext=ext, size=len(thumbnail),
+                             digest=artifact_store.put(thumbnail, ext)))
+
+        # kept for as long as artifact_retention allows from the diff's day
+        for row in rows:
+            row['created'] = self.created
+        with db.atomic():
+            replaced = list(Artifact.select().where(Artifact.diff == self.id))
+            Artifact.delete().where(Artifact.diff == self.id).execute()
+            Artifact.insert_many(rows).execute()
+        _remove_unused(replaced)
+        for path in paths:
+            os.remove(path)
+
+
+def _copies(version_id):
+    # the version and the versions that share its summary
+    return (EntryVersion.select(EntryVersion.id)
+            .where((EntryVersion.id == version_id) | (EntryVersion.same_as == version_id)))
+
+
+class Job(BaseModel):
+    """
+    Something to be done by the outbox: 'archive' a version at the Wayback
+    Machine or 'tweet' a diff. Tweets record the feed they came from so
+    that its access token can be looked up when it is sent, rather than
+    keeping a copy of the token in the database.
+    """
+    kind = CharField()
+    version = ForeignKeyField(EntryVersion, null=True, related_name='jobs')
+    diff = ForeignKeyField(Diff, null=True, related_name='jobs')
+    feed = CharField(null=True)
+    # pending, running, done or failed
+    state = CharField(default='pending')
+    attempts = IntegerField(default=0)
+    run_at = DateTimeField(default=datetime.utcnow)
+    created = DateTimeField(default=datetime.utcnow)
+    finished = DateTimeField(null=True)
+    error = TextField(null=True)
+
+    class Meta:
+        indexes = (
+            (('state', 'run_at'), False),
+        )
+
+    def perform(self):
+        if self.kind == 'archive':
+            try:
+                version = self.version
+            except EntryVersion.DoesNotExist:
+                logging.info("version for job %s has been deleted", self.id)
+                return
+            if not version.archive_url:
+                version.archive()
+        elif self.kind == 'tweet':
+            tweet_diff(self.diff, feed_token(self.feed))
+        else:
+            raise ValueError("unknown kind of job: %s" % self.kind)
+
+
+class Lease(BaseModel):
+    """
+    A claim on something, like "entry:42", held by one process until
+    expires. Sharded workers take leases on the entries they are about to
+    check so that an entry in feeds belonging to two shards is only
+    fetched and diffed by one of them.
+    """
+    name = CharField(unique=True)
+    owner = CharField()
+    expires = DateTimeField(index=True)
+
+
+class EditStats(BaseModel):
+    """
+    For a feed ("feed:<url>") or a host ("host:<netloc>"), how many entries
+    have lived through an age bucket, and how many diffs they had in it.
+    See scheduling.py. The row with key "learned" records, as a unix time
+    in exposure, when learn_schedule has counted up to.
+    """
+    key = CharField()
+    bucket = IntegerField()
+    edits = IntegerField(default=0)
+    exposure = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('key', 'bucket'), True),
+        )
 
-        screenshot = self.screenshot_path(html_path)
-        logging.debug("creating image screenshot %s", screenshot)
-        self.browser.set_window_size(1400, 1000)
-        self.browser.get(html_path)
-        time.sleep(5) # give the page time to load
-        self.browser.save_screenshot(screenshot)
 
-        thumbnail = self.thumbnail_path(html_path)
-        logging.debug("creating image thumbnail %s", thumbnail)
-        self.browser.set_window_size(800, 400)
-        self.browser.execute_script("clip()")
-        self.browser.save_screenshot(thumbnail)
+class Artifact(BaseModel):
+    """
+    The index of the artifact store: the digest of the html, screenshot
+    and thumbnail of each diff, so finding them doesn't touch the disk.
+    """
+    diff = ForeignKeyField(Diff, related_name='artifacts')
+    kind = CharField()
+    digest = CharField(index=True)
+    ext = CharField()
+    size = IntegerField()
+    created = DateTimeField(default=datetime.utcnow, index=True)
+
+    class Meta:
+        indexes = (
+            (('diff', 'kind'), True),
+        )
+
+
+MODELS = [Feed, Entry, FeedEntry, EntryVersion, Diff, Job, Lease, EditStats, Artifact]
+
+# jobs are run inline until setup_outbox starts the workers
+outbox = Outbox(Job, workers=0)
+
+metrics.registry.gauge("diffengine_screenshot_queue_depth",
+                       "Diffs waiting for their screenshots",
+                       function=lambda: screenshots.depth())
+metrics.registry.gauge("diffengine_outbox_depth",
+                       "Outbox jobs waiting to be run",
+                       function=lambda: outbox.depth())
 
 
 def setup_logging():
@@ -433,13 +1044,14 @@ def setup_logging():
     logging.getLogger("tweepy.binder").setLevel(logging.ERROR)
     logging.getLogger("peewee").setLevel(logging.ERROR)
     logging.getLogger("requests_oauthlib").setLevel(logging.ERROR)
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 
 def load_config(prompt=True):
     global config
     config_file = os.path.join(home, "config.yaml")
     if os.path.isfile(config_file):
-        config = yaml.load(open(config_file))
+        config = yaml.safe_load(open(config_file))
     else:
         if not os.path.isdir(home):
             os.makedirs(home)
@@ -449,6 +1061,9 @@ def load_config(prompt=True):
 
 
 def get_initial_config():
+    import tweepy
+    import feedparser
+
     config = {"feeds": [], "phantomjs": "phantomjs"}
 
     while len(config['feeds']) == 0:
@@ -497,12 +1112,477 @@ def setup_db():
     global db
     db_file = config.get('db', home_path('diffengine.db'))
     logging.debug("connecting to db %s", db_file)
-    db.init(db_file)
+    # wait for a busy database rather than failing straight away
+    db.init(db_file, timeout=config.get('db_timeout', 30))
     db.connect()
-    db.create_tables([Feed, Entry, FeedEntry, EntryVersion, Diff], safe=True)
+    db.create_tables(MODELS, safe=True)
+    migrate_db()
+
+
+def migrate_db():
+    """
+    Brings a database created by an older version of diffengine up to date
+    by adding any columns that the models have gained since.
+    """
+    from playhouse.migrate import SqliteMigrator, migrate
+    migrator = SqliteMigrator(db)
+    added = set()
+    for model in MODELS:
+        table = model._meta.db_table
+        columns = [c.name for c in db.get_columns(table)]
+        for field in model._meta.sorted_fields:
+            if field.db_column not in columns:
+                logging.info("adding column %s.%s", table, field.db_column)
+                migrate(migrator.add_column(table, field.db_column, field))
+                added.add((table, field.db_column))
+
+        # tables that already exist don't get their indexes from create_tables
+        compiler = db.compiler()
+        indexes = [i.name for i in db.get_indexes(table)]
+        for fields, unique in model._index_data():
+            fields = [model._meta.fields[f] if isinstance(f, str) else f for f in fields]
+            name = compiler.index_name(table, [f.db_column for f in fields])
+            if name in indexes:
+                continue
+            if model is FeedEntry and unique:
+                FeedEntry.remove_duplicates()
+            logging.info("adding index %s", name)
+            db.create_index(model, fields, unique)
+
+    if ("entry", "next_check_at") in added:
+        backfill_schedule()
+
+    # feeds no longer keep a content hash, but databases that were
+    # migrated while they did still have the column
+    if 'content_hash' in [c.name for c in db.get_columns('feed')]:
+        logging.info("dropping column feed.content_hash")
+        migrate(migrator.drop_column('feed', 'content_hash'))
+
+
+def backfill_schedule():
+    """
+    Works out next_check_at for entries that were created before it was
+    added. Anything older than max_age is left null and so never checked.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+    entries = list(Entry.select().where(Entry.created > cutoff))
+    logging.info("scheduling %s existing entries", len(entries))
+    with db.atomic():
+        for entry in entries:
+            entry.schedule()
+            entry.save(only=[Entry.next_check_at])
+
+
+def setup_shard(value=None):
+    """
+    Sets which shard this process works on from a string like "0/4", or
+    the shard in the config. None means all of the feeds.
+    """
+    global shard
+    value = value or config.get('shard')
+    shard = _parse_shard(value) if value else None
+    if shard:
+        logging.info("working on shard %s of %s", shard[0], shard[1])
+
+
+def shard_of(url, count):
+    # sha1 rather than hash() so that every process agrees, and rather
+    # than crc32 which puts urls that differ by a digit in the same shard
+    return int(hashlib.sha1(url.encode('utf8')).hexdigest()[:8], 16) % count
+
+
+def shard_feeds(feed_configs):
+    """
+    Returns the feeds in feed_configs that belong to this process's shard.
+    """
+    if not shard:
+        return list(feed_configs)
+    index, count = shard
+    return [f for f in feed_configs if shard_of(f['url'], count) == index]
+
+
+def claim_leases(names, seconds=600, owner=None):
+    """
+    Takes out leases on the given names for seconds, and returns the set
+    of names that this owner now holds. Leases that have run out, or that
+    the owner already holds, are taken over.
+    """
+    owner = owner or lease_owner
+    now = datetime.utcnow()
+    expires = now + timedelta(seconds=seconds)
+    claimed = set()
+    for chunk in _chunks(list(names), 500):
+        # IMMEDIATE takes the write lock up front, so processes take
+        # turns rather than both seeing a name as free
+        with db.atomic('IMMEDIATE'):
+            (Lease.update(owner=owner, expires=expires)
+                .where(Lease.name << chunk,
+                       (Lease.expires < now) | (Lease.owner == owner))
+                .execute())
+            held = dict(Lease.select(Lease.name, Lease.owner)
+                        .where(Lease.name << chunk)
+                        .tuples())
+            free = [n for n in chunk if n not in held]
+            for rows in _chunks(free, 100):
+                Lease.insert_many([{'name': n, 'owner': owner, 'expires': expires}
+                                   for n in rows]).execute()
+        claimed.update(n for n, o in held.items() if o == owner)
+        claimed.update(free)
+    return claimed
+
+
+def release_leases(names, owner=None):
+    owner = owner or lease_owner
+    for chunk in _chunks(list(names), 500):
+        Lease.delete().where(Lease.name << chunk, Lease.owner == owner).execute()
+
+
+def shard_stats(count):
+    """
+    Returns a list of dictionaries, one for each of count shards, with the
+    number of feeds, entries, entries that are due and entries checked in
+    the last day, along with a dictionary of how many live leases each
+    owner holds.
+    """
+    stats = [dict(shard=i, feeds=0, entries=0, due=0, checked_today=0)
+             for i in range(count)]
+    for feed_config in config.get('feeds', []):
+        stats[shard_of(feed_config['url'], count)]['feeds'] += 1
+
+    now = datetime.utcnow()
+    day_ago = now - timedelta(days=1)
+    query = (Entry.select(Entry.next_check_at, Entry.checked, fn.MIN(FeedEntry.feed))
+             .join(FeedEntry)
+             .group_by(Entry.id)
+             .tuples())
+    for next_check_at, checked, feed_url in list(query):
+        s = stats[shard_of(feed_url, count)]
+        s['entries'] += 1
+        if next_check_at and next_check_at <= now:
+            s['due'] += 1
+        if checked and checked >= day_ago:
+            s['checked_today'] += 1
+
+    leases = dict(Lease.select(Lease.owner, fn.COUNT(Lease.id))
+                  .where(Lease.expires > now)
+                  .group_by(Lease.owner)
+                  .tuples())
+    return stats, leases
+
+
+def print_shard_stats(count):
+    stats, leases = shard_stats(count)
+    print("shard  feeds  entries      due  checked today")
+    for s in stats:
+        print("%5d %6d %8d %8d %14d" % (s['shard'], s['feeds'], s['entries'],
+                                       s['due'], s['checked_today']))
+    for owner, n in sorted(leases.items()):
+        print("%s holds %s leases" % (owner, n))
+
+
+def learn_schedule(now=None, batch_size=500):
+    """
+    Adds to EditStats the entries that have been checked through an age
+    bucket since the last time this was run, along with the diffs they had
+    in it, so that only new history is looked at. A bucket is looked at
+    once it has been over for as long again as it lasted, which leaves time
+    for the check after it. Entries that weren't checked after the end of
+    a bucket, because they stopped being checked, aren't counted in it. The
+    first run goes through all of the history. Returns the number of entries
+    and buckets counted.
+    """
+    # to the second, as that is all the "learned" row keeps
+    now = (now or datetime.utcnow()).replace(microsecond=0)
+    learned, _ = EditStats.get_or_create(key='learned', bucket=0)
+    since = datetime.utcfromtimestamp(learned.exposure)
+    bounds = scheduling.buckets(max_age)
+    settled = [2 * end - start for start, end in bounds]
+
+    # the counting is only reads, so it is done a batch of entries at a
+    # time without holding up the shards that are writing
+    counts = {}
+    counted = 0
+    last_id = 0
+    while True:
+        entries = list(Entry.select(Entry.id, Entry.url, Entry.created, Entry.checked)
+                       .where(Entry.id > last_id,
+                              Entry.created > since - timedelta(seconds=max(settled)),
+                              Entry.created <= now - timedelta(seconds=min(settled)))
+                       .order_by(Entry.id)
+                       .limit(batch_size)
+                       .tuples())
+        if not entries:
+            break
+        last_id = entries[-1][0]
+        counted += _count_edits(entries, bounds, since, now, counts)
+
+    # IMMEDIATE so that shards learning at the same time take turns, and
+    # if another one got here first what was counted is already in
+    with db.atomic('IMMEDIATE'):
+        learned = EditStats.get(EditStats.key == 'learned', EditStats.bucket == 0)
+        if learned.exposure != calendar.timegm(since.utctimetuple()):
+            return 0
+        for (key, bucket), (edits, exposure) in counts.items():
+            EditStats.get_or_create(key=key, bucket=bucket)
+            (EditStats.update(edits=EditStats.edits + edits,
+                              exposure=EditStats.exposure + exposure)
+             .where(EditStats.key == key, EditStats.bucket == bucket)
+             .execute())
+        learned.exposure = calendar.timegm(now.utctimetuple())
+        learned.save()
+    logging.info("learned from %s entries", counted)
+    return counted
+
+
+def _count_edits(entries, bounds, since, now, counts):
+    # adds the (edits, exposure) of a batch of (id, url, created, checked)
+    # entries to counts for each bucket that settled between since and now
+    # and that they were checked through, and returns how many entries and
+    # buckets that was
+    ids = [entry[0] for entry in entries]
+    feeds = {}
+    query = (FeedEntry.select(FeedEntry.entry, FeedEntry.feed)
+             .where(FeedEntry.entry << ids)
+             .tuples())
+    for entry_id, feed_url in query:
+        feeds.setdefault(entry_id, feed_url)
+    # get_latest only keeps the diffs that it could generate, so each one
+    # is an edit
+    diffs = {}
+    query = (Diff.select(EntryVersion.entry, Diff.created)
+             .join(EntryVersion, on=(Diff.new == EntryVersion.id))
+             .where(EntryVersion.entry << ids)
+             .tuples())
+    for entry_id, diff_created in query:
+        diffs.setdefault(entry_id, []).append(diff_created)
+
+    counted = 0
+    for entry_id, url, created, checked in entries:
+        keys = _schedule_keys(url, feeds.get(entry_id))
+        ages = [(d - created).total_seconds() for d in diffs.get(entry_id, [])]
+        for bucket, (start, end) in enumerate(bounds):
+            settled = created + timedelta(seconds=2 * end - start)
+            if not since < settled <= now:
+                continue
+            if checked is None or checked < created + timedelta(seconds=end):
+                continue
+            counted += 1
+            edits = sum(1 for age in ages if start <= age < end)
+            for key in keys:
+                c = counts.setdefault((key, bucket), [0, 0])
+                c[0] += edits
+                c[1] += 1
+    return counted
+
+
+def load_edit_model():
+    stats = {}
+    query = (EditStats.select(EditStats.key, EditStats.bucket, EditStats.edits,
+                              EditStats.exposure)
+             .where(EditStats.key != 'learned')
+             .tuples())
+    for key, bucket, edits, exposure in query:
+        stats.setdefault(key, {})[bucket] = (edits, exposure)
+    return scheduling.EditModel(stats, stale_ratio, min_wait, max_age,
+                                target=config.get('edit_target', 0.05))
+
+
+def setup_schedule(force=False):
+    """
+    Learns from the latest history and sets edit_model when the scheduler
+    is adaptive, no more than once every learn_interval seconds.
+    """
+    global edit_model, learned_at
+    if config.get('scheduler') != 'adaptive':
+        edit_model = None
+        return
+    if edit_model and not force and \
+            time.time() - learned_at < config.get('learn_interval', 3600):
+        return
+    learn_schedule()
+    edit_model = load_edit_model()
+    learned_at = time.time()
+
+
+def schedule_report(limit=10000):
+    """
+    Plays the edit history of the most recent limit entries through both
+    the stale_ratio heuristic and what learn_schedule has learned, and
+    returns a dictionary of feed url to the number of entries, fetches
+    and edits caught by each, with the totals under None. Edits are only
+    known when they were caught by the checks that actually happened, so
+    this can't show edits that both would miss.
+    """
+    learn_schedule()
+    model = load_edit_model()
+    now = datetime.utcnow()
+    entries = dict((entry_id, (url, created)) for entry_id, url, created in
+                   Entry.select(Entry.id, Entry.url, Entry.created)
+                   .order_by(Entry.id.desc())
+                   .limit(limit)
+                   .tuples())
+    feeds = {}
+    edits = dict((entry_id, []) for entry_id in entries)
+    for chunk in _chunks(list(entries), 500):
+        query = (FeedEntry.select(FeedEntry.entry, FeedEntry.feed)
+                 .where(FeedEntry.entry << chunk)
+                 .tuples())
+        for entry_id, feed_url in query:
+            feeds.setdefault(entry_id, feed_url)
+        query = (Diff.select(EntryVersion.entry, Diff.created)
+                 .join(EntryVersion, on=(Diff.new == EntryVersion.id))
+                 .where(EntryVersion.entry << chunk)
+                 .tuples())
+        for entry_id, diff_created in query:
+            edits[entry_id].append((diff_created - entries[entry_id][1]).total_seconds())
+
+    report = {}
+    for entry_id, (url, created) in entries.items():
+        feed_url = feeds.get(entry_id)
+        keys = _schedule_keys(url, feed_url)
+        until = min((now - created).total_seconds(), max_age)
+        heuristic = scheduling.simulate(model.heuristic_wait, edits[entry_id], until)
+        adaptive = scheduling.simulate(lambda age: model.wait(age, *keys),
+                                       edits[entry_id], until)
+        for name in (feed_url, None):
+            r = report.setdefault(name, dict(entries=0, edits=0,
+                                             heuristic_fetches=0, heuristic_caught=0,
+                                             adaptive_fetches=0, adaptive_caught=0))
+            r['entries'] += 1
+            r['edits'] += len(edits[entry_id])
+            r['heuristic_fetches'] += heuristic[0]
+            r['heuristic_caught'] += heuristic[1]
+            r['adaptive_fetches'] += adaptive[0]
+            r['adaptive_caught'] += adaptive[1]
+    return report
+
+
+def print_schedule_report(limit=10000):
+    report = schedule_report(limit)
+    print("entries    edits  fetches  adaptive    saved  caught  adaptive  feed")
+    for feed_url, r in sorted(report.items(), key=lambda i: (i[0] is None, i[0] or "")):
+        saved = r['heuristic_fetches'] - r['adaptive_fetches']
+        print("%7d %8d %8d %9d %7.1f%% %7d %9d  %s" % (
+            r['entries'], r['edits'], r['heuristic_fetches'], r['adaptive_fetches'],
+            100.0 * saved / max(r['heuristic_fetches'], 1),
+            r['heuristic_caught'], r['adaptive_caught'], feed_url or "all feeds"))
+
+
+def setup_throttle():
+    global throttle
+    throttle = HostThrottle(
+        rate=config.get('host_rate', 1.0),
+        burst=config.get('host_burst', 1)
+    )
+
+
+def setup_session():
+    global session, outbox_session
+    if session:
+        session.close()
+    if outbox_session:
+        outbox_session.close()
+    pool_size = max(config.get('pool_size', 10), config.get('concurrency', 4))
+    session = Session(
+        user_agent=UA,
+        pool_connections=config.get('pool_hosts', 10),
+        pool_maxsize=pool_size,
+        retries=config.get('retries', 3),
+        backoff=config.get('retry_backoff', 0.5),
+        max_backoff=config.get('retry_max_backoff', 10),
+        max_size=config.get('max_response_size', 10 * 1024 * 1024)
+    )
+    # a 429 or 5xx from the Wayback Machine has to reach the outbox, which
+    # backs off and retries the job without holding up the other workers
+    outbox_session = Session(
+        user_agent=UA,
+        pool_connections=1,
+        pool_maxsize=max(config.get('outbox_workers', 1), 1),
+        retries=config.get('retries', 3),
+        backoff=config.get('retry_backoff', 0.5),
+        max_backoff=config.get('retry_max_backoff', 10),
+        max_size=config.get('max_response_size', 10 * 1024 * 1024),
+        retry_statuses=()
+    )
+
+
+def setup_warc():
+    global warc
+    if warc:
+        warc.close()
+        warc = None
+    if config.get('warc_dir'):
+        warc = WarcWriter(home_path(config['warc_dir']),
+                          max_size=config.get('warc_max_size', 1024 ** 3))
+
+
+def setup_artifacts():
+    global artifact_store
+    artifact_store = None
+    if config.get('artifact_store'):
+        artifact_store = ArtifactStore(home_path(config.get('artifact_dir', 'artifacts')))
+
+
+def setup_screenshots(workers=None, browsers=None):
+    global screenshots
+    screenshots.close()
+    # images drawn with pillow don't need any browsers
+    pool = None
+    if config.get('renderer') != 'pillow':
+        pool = BrowserPool(
+            executable=config.get('phantomjs', 'phantomjs'),
+            size=browsers or config.get('browsers', 2)
+        )
+    if workers is None:
+        workers = config.get('render_workers', 2)
+    screenshots = ScreenshotQueue(pool, workers=workers)
+    atexit.register(screenshots.close)
+
+
+def wait_for_screenshots():
+    screenshots.join()
+
+
+def setup_extractor():
+    global extractor
+    extractor.close()
+    extractor = Extractor(
+        workers=config.get('extract_workers', 0),
+        timeout=config.get('extract_timeout', 30)
+    )
+    atexit.register(extractor.close)
+
+
+def setup_metrics():
+    """
+    Starts serving the metrics over http if metrics_port is set.
+    """
+    global metrics_server
+    if metrics_server:
+        metrics_server.close()
+        metrics_server = None
+    port = config.get('metrics_port')
+    if port:
+        metrics_server = metrics.Server(metrics.registry, port)
+        logging.info("serving metrics on port %s", metrics_server.port)
+
+
+def export_metrics():
+    """
+    Writes the metrics to metrics_file, if it is set, in the Prometheus
+    text format.
+    """
+    path = config.get('metrics_file')
+    if path:
+        try:
+            metrics.registry.write(home_path(path))
+        except OSError as e:
+            logging.error("unable to write metrics to %s: %s", path, e)
 
 
 def setup_phantomjs():
+    if config.get('renderer') == 'pillow':
+        return
     phantomjs = config.get("phantomjs", "phantomjs")
     try:
         subprocess.check_output([phantomjs, '--version'])
@@ -512,7 +1592,68 @@ def setup_phantomjs():
         sys.exit()
 
 
+def setup_outbox():
+    global outbox
+    outbox.close()
+    outbox = Outbox(
+        Job,
+        workers=config.get('outbox_workers', 1),
+        max_attempts=config.get('outbox_attempts', 5),
+        backoff=config.get('outbox_backoff', 60),
+        lease=config.get('outbox_lease', 300)
+    )
+    atexit.register(outbox.close)
+
+
+def feed_token(feed_url):
+    """
+    Returns the twitter access token for a feed in the config, or None if
+    the feed doesn't tweet.
+    """
+    for feed_config in config.get('feeds', []):
+        if feed_config['url'] == feed_url:
+            if feed_config.get('tweet', True) is False:
+                return None
+            return feed_config.get('twitter')
+    return None
+
+
+def tweeted_copy(diff, feed_url):
+    """
+    Returns True if a diff that shares its html and images with this one
+    has already been queued to tweet from the feed's twitter account, so
+    that a wire story in several feeds is only tweeted once per account.
+    """
+    original = diff.same_as or diff.id
+    copies = (Diff.select(Diff.id)
+              .where((Diff.id == original) | (Diff.same_as == original), Diff.id != diff.id))
+    jobs = Job.select(Job.feed).where(Job.kind == 'tweet', Job.diff << copies)
+    token = feed_token(feed_url)
+    return any(feed_token(job.feed) == token for job in jobs)
+
+
+def twitter_client(token):
+    """
+    Returns an authenticated tweepy client for the access token, which is
+    made once and reused for every tweet sent with that token.
+    """
+    t = config['twitter']
+    key = (t['consumer_key'], token['access_token'])
+    twitter = twitter_clients.get(key)
+    if twitter is None:
+        import tweepy
+        auth = tweepy.OAuthHandler(t['consumer_key'], t['consumer_secret'])
+        auth.secure = True
+        auth.set_access_token(token['access_token'], token['access_token_secret'])
+        twitter = twitter_clients[key] = tweepy.API(auth)
+    return twitter
+
+
 def tweet_diff(diff, token):
+    """
+    Tweets the diff's thumbnail. Errors are raised so that the outbox can
+    try again later, with RateLimited when twitter says to slow down.
+    """
     if 'twitter' not in config:
         logging.debug("twitter not configured")
         return
@@ -524,11 +1665,7 @@ def tweet_diff(diff, token):
         return
 
     logging.info("tweeting about  %s", diff.new.title)
-    t = config['twitter']
-    auth = tweepy.OAuthHandler(t['consumer_key'], t['consumer_secret'])
-    auth.secure = True
-    auth.set_access_token(token['access_token'], token['access_token_secret'])
-    twitter = tweepy.API(auth)
+    twitter = twitter_client(token)
 
     status = diff.new.title
     status = status.replace('| Stuff.co.nz', '')
@@ -540,11 +1677,14 @@ def tweet_diff(diff, token):
 
     try:
         twitter.update_with_media(diff.thumbnail_path(), status)
-        diff.tweeted = datetime.utcnow()
-        logging.info("tweeted %s", status)
-        diff.save()
     except Exception as e:
-        logging.exception("unable to tweet")
+        # tweepy 3 raises RateLimitError and tweepy 4 TooManyRequests
+        if type(e).__name__ in ('RateLimitError', 'TooManyRequests'):
+            raise RateLimited(_rate_limit_reset(e))
+        raise
+    diff.tweeted = datetime.utcnow()
+    logging.info("tweeted %s", status)
+    diff.save(only=[Diff.tweeted])
 
 
 def init(new_home, prompt=True):
@@ -554,6 +1694,49 @@ def init(new_home, prompt=True):
     setup_phantomjs()
     setup_logging()
     setup_db()
+    setup_throttle()
+    setup_session()
+    setup_warc()
+    setup_artifacts()
+    setup_screenshots()
+    setup_extractor()
+    setup_outbox()
+    setup_metrics()
+
+
+def reload():
+    """
+    Rereads the config and rebuilds the parts that depend on it, which is
+    what a running daemon does when it gets a SIGHUP.
+    """
+    logging.info("reloading config")
+    load_config(prompt=False)
+    setup_throttle()
+    setup_session()
+    setup_warc()
+    setup_artifacts()
+    setup_screenshots()
+    setup_extractor()
+    twitter_clients.clear()
+    setup_outbox()
+    setup_metrics()
+    setup_schedule(force=True)
+
+
+def shutdown():
+    outbox.close()
+    screenshots.close()
+    extractor.close()
+    if session:
+        session.close()
+    if outbox_session:
+        outbox_session.close()
+    if warc:
+        warc.close()
+    export_metrics()
+    if metrics_server:
+        metrics_server.close()
+    db.close()
 
 
 def rerun(entry_id):
@@ -561,126 +1744,666 @@ def rerun(entry_id):
                     .join(Entry) \
                     .where(Entry.id == entry_id)\
                     .order_by(-EntryVersion.created)[0]
-    diff = entry_version.diff()
-    original_path = diff.html_path()
+    diff = entry_version.diff
+    if diff is None:
+        logging.error("entry %s doesn't have a diff to rerun", entry_id)
+        return
+    # the artifact store is only for the real thing
+    original_path = diff.work_path() if artifact_store else diff.html_path()
     i = 1
     #Find the first available path
     while i < 100:
         rerun_path = original_path.replace(".html", "-rerun-" + str(i) + ".html")
-        if not rerun_path.isfile():
+        if not os.path.isfile(rerun_path):
             break
         else:
             i += 1
 
-    diff.generate(rerun_path)
+    diff.generate(rerun_path, exclude=_diff_exclusions(diff))
     logging.info("Rerun complete, check %s for output", rerun_path)
 
 
-def process_feed():
-    checked = skipped = new = tweeted = diffs = 0
+def rerender(feeds=None, since=None, until=None, entries=None, in_place=False,
+             workers=None):
+    """
+    Renders the html and images of past diffs again, such as after the
+    template or the exclusion rules have changed. Diffs can be picked by
+    feed url, by when they were created and by entry id. The new files go
+    next to the old ones with -rerender in their names, or over them when
+    in_place is set, and each one is written to a temporary file first and
+    then renamed, so a file is never left half written.
+
+    The diffs are shared out between worker processes. Each diff that is
+    done is noted in a checkpoint file, so an interrupted rerender picks up
+    where it left off when it is run again with the same options. Returns
+    a dictionary of how many diffs were rendered, were skipped because
+    they were done already, no longer had any changes, or failed.
+    """
+    query = (Diff.select(Diff.id, Diff.same_as)
+             .join(EntryVersion, on=(Diff.new == EntryVersion.id)))
+    if feeds:
+        in_feeds = FeedEntry.select(FeedEntry.entry).where(FeedEntry.feed << feeds)
+        query = query.where(EntryVersion.entry << in_feeds)
+    if entries:
+        query = query.where(EntryVersion.entry << entries)
+    if since:
+        query = query.where(Diff.created >= since)
+    if until:
+        query = query.where(Diff.created < until)
+    # copies of a diff use its files, so it is the one that gets rendered
+    ids = sorted(set(same_as or diff_id for diff_id, same_as in query.tuples()))
+
+    options = json.dumps([feeds, str(since), str(until), entries, in_place], sort_keys=True)
+    checkpoint = home_path("rerender-%s.checkpoint" %
+                           hashlib.sha1(options.encode("utf8")).hexdigest()[:10])
+    done = set()
+    if os.path.isfile(checkpoint):
+        with open(checkpoint) as fh:
+            done = set(int(line) for line in fh if line.strip().isdigit())
+    todo = [diff_id for diff_id in ids if diff_id not in done]
+    counts = {"rendered": 0, "skipped": len(ids) - len(todo), "unchanged": 0, "failed": 0}
+    logging.info("rerendering %s diffs, %s already done", len(todo), counts["skipped"])
+
+    if workers is None:
+        workers = config.get('rerender_workers', os.cpu_count() or 1)
+    pool = None
+    if workers > 0 and len(todo) > 1:
+        pool = get_context("spawn").Pool(workers, initializer=_rerender_setup,
+                                         initargs=(home,))
+        results = pool.imap(functools.partial(_rerender_diff, in_place=in_place),
+                            todo, chunksize=4)
+    else:
+        results = (_rerender_diff(diff_id, in_place) for diff_id in todo)
 
+    try:
+        with open(checkpoint, "a") as fh:
+            for n, (diff_id, outcome, error) in enumerate(results, 1):
+                counts[outcome] += 1
+                if outcome == "failed":
+                    logging.error("unable to rerender diff %s: %s", diff_id, error)
+                    continue
+                fh.write("%s\n" % diff_id)
+                fh.flush()
+                if n % 100 == 0:
+                    logging.info("rerendered %s of %s diffs", n, len(todo))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if not counts["failed"]:
+        os.remove(checkpoint)
+    logging.info("rerender finished: %s", counts)
+    return counts
+
+
+def _rerender_setup(new_home):
+    # runs in each rerender worker process, which doesn't need everything
+    # that init sets up, and mustn't start an outbox of its own
+    global home
+    home = new_home
+    load_config(prompt=False)
+    setup_logging()
+    db.init(config.get('db', home_path('diffengine.db')),
+            timeout=config.get('db_timeout', 30))
+    db.connect()
+    setup_artifacts()
+    setup_screenshots(workers=0, browsers=1)
+    # worker processes don't run atexit handlers, but they do run these
+    from multiprocessing.util import Finalize
+    Finalize(screenshots, screenshots.close, exitpriority=10)
+
+
+def _rerender_diff(diff_id, in_place=False):
+    """
+    Renders one diff to temporary files and moves them into place, and
+    returns (diff_id, outcome, error).
+    """
+    tmp_paths = []
+    try:
+        diff = Diff.get(Diff.id == diff_id)
+        path = diff.work_path() if artifact_store else diff.html_path()
+        if not in_place:
+            path = path.replace(".html", "-rerender.html")
+        targets = [path, diff.screenshot_path(path), diff.thumbnail_path(path)]
+        tmp = path.replace(".html", ".tmp-%s.html" % os.getpid())
+        tmp_paths = [tmp, diff.screenshot_path(tmp), diff.thumbnail_path(tmp)]
+        for p in tmp_paths:
+            if os.path.isfile(p):
+                os.remove(p)
+
+        if not diff.generate(tmp, exclude=_diff_exclusions(diff)):
+            return diff_id, "unchanged", None
+        wait_for_screenshots()
+        if not all(os.path.isfile(p) for p in tmp_paths):
+            return diff_id, "failed", "images weren't rendered"
+        if artifact_store and in_place:
+            diff.store_artifacts(tmp)
+            return diff_id, "rendered", None
+        for tmp_path, target in zip(tmp_paths, targets):
+            os.replace(tmp_path, target)
+        return diff_id, "rendered", None
+    except Exception as e:
+        return diff_id, "failed", str(e)
+    finally:
+        for p in tmp_paths:
+            if os.path.isfile(p):
+                os.remove(p)
+
+
+def _diff_exclusions(diff):
+    # the rules of the first feed in the config that the entry is in
+    feed_urls = set(fe.feed_id for fe in
+                    FeedEntry.select(FeedEntry.feed).where(FeedEntry.entry == diff.new.entry_id))
     for feed_config in config.get('feeds', []):
-        feed_name = feed_config['name']
-        logging.debug("Processing feed: %s", feed_name)
-
-        #Tweeting config - default to on but require config
-        tweeting = True
-        if feed_config.get('tweet', True) is False:
-            logging.info("Tweeting disabled for feed %s", feed_name)
-            tweeting = False
-        if 'twitter' not in feed_config:
-            logging.info("No twitter config for feed %s", feed_name)
-            tweeting = False
-        #Wayback config
-        archive_enabled = feed_config.get('archive')
-        if archive_enabled:
-            logging.info("Wayback archive enabled for feed %s", feed_name)
-
-        #Process feed
+        if feed_config['url'] in feed_urls:
+            return exclusions.compile_rules(exclusions.rules_for(config, feed_config))
+    return exclusions.compile_rules(exclusions.rules_for(config, {}))
+
+
+def replay(directory):
+    """
+    Runs diffengine again over the feeds and pages captured in the WARC
+    files in directory, without going to the network. Each run that was
+    captured is replayed in turn: the feeds are refreshed, the entries
+    that were fetched in that run are checked, and they see what was
+    captured then. The validators from earlier fetches are forgotten, so
+    every page is extracted again. Nothing is archived or tweeted. Returns
+    the number of entries checked.
+    """
+    global session, throttle, warc
+    archive = WarcArchive(directory)
+    saved = session, throttle, warc
+    # the pages are on disk, so there is no one to be polite to
+    session, throttle, warc = archive, HostThrottle(rate=0), None
+    checked = 0
+    try:
+        for run in archive.runs():
+            archive.run = run
+            urls = archive.urls(run)
+            logging.info("replaying run %s with %s urls", run, len(urls))
+            Feed.update(etag=None, last_modified=None).execute()
+            options = refresh_feeds()
+            now = datetime.utcnow()
+            for chunk in _chunks(list(urls), 500):
+                (Entry.update(next_check_at=now, etag=None, last_modified=None,
+                              content_hash=None)
+                 .where(Entry.url << chunk)
+                 .execute())
+            options = dict((url, (False, None, exclude))
+                           for url, (archive_enabled, token, exclude) in options.items())
+            checked += check_due(options, config.get('budget', 1000))
+    finally:
+        session, throttle, warc = saved
+    return checked
+
+
+def backfill_fingerprints(batch_size=500):
+    """
+    Stores fingerprint digests for versions that were saved before the
+    fingerprint column existed, a batch at a time so that it can be
+    interrupted and picked up again later.
+    """
+    total = 0
+    while True:
+        versions = list(EntryVersion.select()
+                        .where(EntryVersion.fingerprint >> None)
+                        .limit(batch_size))
+        if not versions:
+            break
+        with db.atomic():
+            for version in versions:
+                (EntryVersion.update(fingerprint=_digest(version.summary))
+                    .where(EntryVersion.id == version.id)
+                    .execute())
+        total += len(versions)
+        logging.info("backfilled fingerprints for %s versions", total)
+    return total
+
+
+def compact_versions(keyframe_interval=10):
+    """
+    Rewrites the versions of every entry so that they are stored as deltas
+    against the version before them, with a full keyframe every
+    keyframe_interval versions, apart from versions that share another
+    version's summary, and then vacuums the database to give the
+    space back.
+    """
+    saved = 0
+    for (entry_id,) in list(Entry.select(Entry.id).tuples()):
+        versions = list(EntryVersion.select()
+                        .where(EntryVersion.entry == entry_id)
+                        .order_by(EntryVersion.created, EntryVersion.id))
+        # materialize everything before any of it is rewritten
+        summaries = [v.summary for v in versions]
+        with db.atomic():
+            previous = None
+            for version, summary in zip(versions, summaries):
+                # shared versions don't have anything of their own to store
+                if version.same_as is not None:
+                    previous = version
+                    continue
+                before = len(version.stored_summary) + len(version.delta or b'')
+                version._summary = summary
+                version.stored_summary = summary
+                version.delta = version.delta_base = None
+                version.chain = 0
+                if previous:
+                    version.delta_from(previous, keyframe_interval)
+                version.save()
+                saved += before - len(version.stored_summary) - len(version.delta or b'')
+                previous = version
+    logging.info("compacted versions, saving about %s bytes", saved)
+    db.execute_sql("VACUUM")
+    return saved
+
+
+def store_existing_artifacts(batch_size=500):
+    """
+    Moves diffs rendered before the artifact store was turned on into it,
+    and removes the day directories they leave empty. Returns the number
+    of diffs moved.
+    """
+    moved = 0
+    stored = Artifact.select(Artifact.diff).where(Artifact.kind == 'html')
+    query = (Diff.select(Diff.id)
+             .where(Diff.same_as >> None, ~(Diff.id << stored))
+             .order_by(Diff.id)
+             .tuples())
+    for (diff_id,) in list(query):
+        diff = Diff.get(Diff.id == diff_id)
+        path = diff.work_path()
+        paths = [path, diff.screenshot_path(path), diff.thumbnail_path(path)]
+        if not all(os.path.isfile(p) for p in paths):
+            continue
+        try:
+            diff.store_artifacts(path)
+        except Exception as e:
+            logging.error("unable to store diff %s: %s", diff.id, e)
+            continue
+        moved += 1
+        if moved % batch_size == 0:
+            logging.info("stored %s diffs", moved)
+    for day in glob.glob(home_path("diffs/*")):
+        if os.path.isdir(day) and not os.listdir(day):
+            os.rmdir(day)
+    logging.info("stored %s diffs", moved)
+    return moved
+
+
+def prune_artifacts(now=None):
+    """
+    Drops artifacts that are older than their kind's number of days in
+    artifact_retention, and deletes their files once no other diff uses
+    them. Returns the number of artifacts dropped.
+    """
+    now = now or datetime.utcnow()
+    dropped = 0
+    for kind, days in config.get('artifact_retention', {}).items():
+        if days is None:
+            continue
+        cutoff = now - timedelta(days=days)
+        while True:
+            batch = list(Artifact.select()
+                         .where(Artifact.kind == kind, Artifact.created < cutoff)
+                         .limit(500))
+            if not batch:
+                break
+            (Artifact.delete()
+             .where(Artifact.id << [a.id for a in batch])
+             .execute())
+            _remove_unused(batch)
+            dropped += len(batch)
+        logging.info("pruned %s older than %s days", kind, days)
+    logging.info("pruned %s artifacts", dropped)
+    return dropped
+
+
+def check_entries(work):
+    """
+    Checks a list of (entry, archive_enabled, exclude) tuples, where exclude
+    is the compiled exclusion pattern for the entry's feed. The pages are fetched
+    by a bounded pool of threads, with each host limited by the throttle,
+    and the html of pages that changed is handed to the extractor. The
+    database work stays on the calling thread and goes through get_latest
+    as each page is ready. Yields (entry, version) for every entry that
+    could be checked.
+    """
+    workers = max(int(config.get('concurrency', 4)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # future -> (entry, options, response, submitted), the response is
+        # None until the fetch has finished, and then submitted is when it
+        # went to the extractor, which gives up on it after extract_timeout
+        pending = {}
+        for entry, archive_enabled, exclude in work:
+            options = (archive_enabled, exclude)
+            pending[pool.submit(entry.fetch)] = (entry, options, None, None)
+
+        while pending:
+            done, _ = wait(list(pending), timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                entry, options, resp, submitted = pending.pop(future)
+                archive_enabled, exclude = options
+                try:
+                    if resp is None:
+                        resp = future.result()
+                        if resp is None:
+                            continue
+                        # no need to extract pages that haven't changed
+                        if entry.unchanged(resp):
+                            yield entry, entry.get_latest(archive_enabled, resp=resp)
+                            continue
+                        submitted = time.monotonic()
+                        extracting = extractor.submit(resp.text, exclude)
+                        pending[extracting] = (entry, options, resp, submitted)
+                    else:
+                        extracted = future.result()
+                        metrics.extract_seconds.observe(time.monotonic() - submitted)
+                        yield entry, entry.get_latest(archive_enabled, resp=resp,
+                                                      extracted=extracted,
+                                                      exclude=exclude)
+                except ExtractionTimeout:
+                    logging.error("timed out extracting %s", entry.url)
+                except Exception as e:
+                    logging.exception('Unable to get latest for entry %s', entry.id)
+            metrics.pages_pending.set(len(pending))
+
+
+def feed_options(feed_config):
+    """
+    Returns (archive_enabled, twitter_token, exclude) for a feed in the
+    config. The token is None when tweeting is turned off or not set up for
+    the feed, and exclude is the feed's exclusion rules compiled into one
+    pattern, or None if it has none.
+    """
+    feed_name = feed_config['name']
+
+    #Tweeting config - default to on but require config
+    token = feed_config.get('twitter')
+    if feed_config.get('tweet', True) is False:
+        logging.info("Tweeting disabled for feed %s", feed_name)
+        token = None
+    elif not token:
+        logging.info("No twitter config for feed %s", feed_name)
+
+    #Wayback config
+    archive_enabled = feed_config.get('archive')
+    if archive_enabled:
+        logging.info("Wayback archive enabled for feed %s", feed_name)
+
+    exclude = exclusions.compile_rules(exclusions.rules_for(config, feed_config))
+
+    return archive_enabled, token, exclude
+
+
+def refresh_feeds(feed_configs=None):
+    """
+    Refreshes the given feeds, or every feed in the config, and returns a
+    dictionary of feed url to the feed's (archive_enabled, twitter_token,
+    exclude) options.
+    """
+    if feed_configs is None:
+        feed_configs = shard_feeds(config.get('feeds', []))
+    options = {}
+    for feed_config in feed_configs:
+        logging.debug("Processing feed: %s", feed_config['name'])
+        options[feed_config['url']] = feed_options(feed_config)
+
         feed, created = Feed.create_or_get(url=feed_config['url'], name=feed_config['name'])
         if created:
             logging.debug("Created new feed for %s", feed_config['url'])
 
         # get latest feed entries
-        feed.refresh_feed()
+        with metrics.timer(metrics.feed_seconds):
+            feed.refresh_feed(feed_config.get('max_items'))
+        logging.debug("Completed processing feed: %s", feed_config['name'])
+    return options
+
+
+def due_entries(feed_urls, budget, now=None):
+    """
+    Returns up to budget entries from the given feeds whose next_check_at
+    has passed, most overdue first, in a single query. An entry that is in
+    more than one feed is only returned once, with the url of one of its
+    feeds as feed_url.
+    """
+    now = now or datetime.utcnow()
+    return (Entry.select(Entry, fn.MIN(FeedEntry.feed).alias('feed_url'))
+            .join(FeedEntry)
+            .where(FeedEntry.feed << feed_urls, Entry.next_check_at <= now)
+            .group_by(Entry.id)
+            .order_by(Entry.next_check_at)
+            .limit(budget))
+
+
+def count_due(feed_urls, now=None):
+    """
+    Returns how many entries in the given feeds are due to be checked,
+    counting an entry that is in more than one of them once.
+    """
+    now = now or datetime.utcnow()
+    return (Entry.select(fn.COUNT(fn.DISTINCT(Entry.id)))
+            .join(FeedEntry)
+            .where(FeedEntry.feed << feed_urls, Entry.next_check_at <= now)
+            .scalar())
+
+
+def next_due(feed_urls):
+    """
+    Returns when the next entry in the given feeds is due to be checked,
+    or None if none of them will be.
+    """
+    entry = (Entry.select(Entry.next_check_at)
+             .join(FeedEntry)
+             .where(FeedEntry.feed << feed_urls, ~(Entry.next_check_at >> None))
+             .order_by(Entry.next_check_at)
+             .first())
+    return entry.next_check_at if entry else None
 
-        # get latest content for each entry
-        for entry in feed.entries:
-            if not entry.stale:
-                skipped += 1
-                logging.debug("%s - Skipping entry not stale", entry.id)
-                continue
-            checked += 1
-            try:
-                version = entry.get_latest(archive_enabled)
-                if version:
-                    new += 1
-                if version and version.diff:
-                    diffs += 1
-                    if tweeting:
-                        tweet_diff(version.diff, feed_config['twitter'])
-                        tweeted += 1
-            except Exception as e:
-                logging.exception('Unable to get latest for entry %s', entry.id)
 
-        logging.debug("Completed processing feed: %s", feed_config['name'])
-    logging.info("Feed processing complete, new: %s, checked: %s, skipped: %s, diffs: %s, tweeted: %s",
-                 new, checked, skipped, diffs, tweeted)
+def process_feed():
+    options = refresh_feeds()
+    checked = check_due(options, config.get('budget', 1000))
+    # publish what we can before exiting, the rest waits for the next run
+    if not outbox.drain(config.get('outbox_timeout', 600)):
+        logging.warning("outbox still busy, %s jobs left", outbox.depth())
+    return checked
+
+
+def check_due(options, budget):
+    """
+    Checks up to budget of the entries that are due in the feeds described
+    by options, which is the dictionary returned by refresh_feeds, and
+    queues tweets for any diffs that are found. Returns the number of
+    entries checked.
+    """
+    new = tweeted = diffs = deferred = 0
+    setup_schedule()
+
+    # only look at the entries that are due, up to the per run budget
+    work = []
+    tweeting = {}
+    for entry in due_entries(list(options.keys()), budget):
+        archive_enabled, token, exclude = options[entry.feed_url]
+        work.append((entry, archive_enabled, exclude))
+        if token:
+            tweeting[entry.id] = entry.feed_url
+    if len(work) == budget:
+        # only this shard's feeds, the others have their own backlogs
+        deferred = count_due(list(options.keys())) - budget
+
+    # other shards can have the same entries in their feeds
+    leases = set()
+    if shard:
+        names = ["entry:%s" % w[0].id for w in work]
+        leases = claim_leases(names, config.get('lease_seconds', 600))
+        leased_elsewhere = len(work) - len(leases)
+        work = [w for w in work if "entry:%s" % w[0].id in leases]
+
+    # get latest content for each entry
+    checked = len(work)
+    logging.info("Checking %s entries", checked)
+    started = time.perf_counter()
+    to_tweet = []
+    for entry, version in check_entries(work):
+        try:
+            if version:
+                new += 1
+            if version and version.diff:
+                diffs += 1
+                if entry.id in tweeting:
+                    to_tweet.append((version.diff, tweeting[entry.id]))
+        except Exception as e:
+            logging.exception('Unable to process new version for entry %s', entry.id)
+
+    release_leases(leases)
+
+    # tweets need the thumbnails, which are taken in the background
+    wait_for_screenshots()
+    for diff, feed_url in to_tweet:
+        if tweeted_copy(diff, feed_url):
+            logging.info("already tweeted a copy of diff %s", diff.id)
+            continue
+        outbox.put('tweet', diff=diff, feed=feed_url)
+        tweeted += 1
+
+    logging.info("Feed processing complete, new: %s, checked: %s, deferred: %s, diffs: %s, tweets queued: %s",
+                 new, checked, deferred, diffs, tweeted)
+    if shard:
+        logging.info("shard %s/%s: checked %s, leased by another shard: %s",
+                     shard[0], shard[1], checked, leased_elsewhere)
+
+    metrics.run_seconds.observe(time.perf_counter() - started)
+    metrics.entries_checked.inc(checked)
+    metrics.new_versions.inc(new)
+    metrics.diffs.inc(diffs)
+    export_metrics()
+    if warc:
+        warc.new_run()
+    return checked
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--home", help='Working directory', default=os.getcwd())
+    parser.add_argument('--rerun', help='Regenerates the most recent diff of the given entity')
+    parser.add_argument('--replay', metavar='DIR',
+                        help='Processes the feeds captured in the WARC files in DIR, offline')
+    parser.add_argument('--rerender', action='store_true',
+                        help='Regenerates the html and images of past diffs, optionally\n'
+                             'only those picked by --feed, --since, --until and --entry')
+    parser.add_argument('--feed', action='append', metavar='URL',
+                        help='Rerenders diffs of entries in this feed, can be repeated')
+    parser.add_argument('--since', type=_date, metavar='YYYY-MM-DD',
+                        help='Rerenders diffs created on or after this day')
+    parser.add_argument('--until', type=_date, metavar='YYYY-MM-DD',
+                        help='Rerenders diffs created before this day')
+    parser.add_argument('--entry', action='append', type=int, metavar='ID',
+                        help='Rerenders diffs of this entry, can be repeated')
+    parser.add_argument('--in-place', action='store_true',
+                        help='Rerenders over the existing files rather than next to them')
+    parser.add_argument('--workers', type=int,
+                        help='Processes to rerender with, one per cpu by default')
+    parser.add_argument('--backfill-fingerprints', action='store_true',
+                        help='Stores fingerprints for versions saved without one')
+    parser.add_argument('--compact', action='store_true',
+                        help='Stores versions as compressed deltas to save space')
+    parser.add_argument('--store-artifacts', action='store_true',
+                        help='Moves existing diffs into the artifact store')
+    parser.add_argument('--prune', action='store_true',
+                        help='Drops artifacts older than artifact_retention allows')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keeps running, checking feeds and entries as they are due')
+    parser.add_argument('--shard', metavar='I/N',
+                        help='Only works on shard I of N, for running several workers')
+    parser.add_argument('--shard-stats', metavar='N', type=int,
+                        help='Reports how the work splits into N shards')
+    parser.add_argument('--schedule-report', action='store_true',
+                        help='Compares the adaptive scheduler with the default one on\n'
+                             'past edits')
+    parser.add_argument('--profile', action='store_true',
+                        help='Prints where the time went when the run finishes')
+    args = parser.parse_args(argv)
+    if args.shard:
+        try:
+            _parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    return args
 
 
-def main(args):
+def main(args=None):
+    if args is None:
+        args = parse_args()
     home = args.home
 
     init(home)
+    setup_shard(args.shard)
     start_time = datetime.utcnow()
     logging.info("starting up with home=%s", home)
     try:
         if args.rerun:
             logging.info("Rerunning last diff for: %s", args.rerun)
             rerun(args.rerun)
+        elif args.replay:
+            replay(args.replay)
+        elif args.rerender:
+            rerender(feeds=args.feed, since=args.since, until=args.until,
+                     entries=args.entry, in_place=args.in_place, workers=args.workers)
+        elif args.backfill_fingerprints:
+            backfill_fingerprints()
+        elif args.compact:
+            compact_versions(config.get('keyframe_interval', 10))
+        elif args.store_artifacts:
+            store_existing_artifacts()
+        elif args.prune:
+            prune_artifacts()
+        elif args.shard_stats:
+            print_shard_stats(args.shard_stats)
+        elif args.schedule_report:
+            print_schedule_report()
+        elif args.daemon:
+            Daemon().run()
         else:
             logging.debug("Processing feeds")
             process_feed()
     except Exception as e:
-        logging.error("Exception in main", e)
+        logging.exception("Exception in main")
+    shutdown()
+    if args.profile:
+        print(metrics.registry.profile())
     elapsed = datetime.utcnow() - start_time
     logging.info("Shutting down, elapsed=%s", elapsed)
 
 
-def _dt(d):
-    return d.strftime("%Y-%m-%d %H:%M:%S")
-
-
-def _normal(s):
-    # additional normalizations for readability + bleached text
-    s = s.replace("\xa0", " ")
-    s = s.replace('“', '"')
-    s = s.replace('”', '"')
-    s = s.replace("’", "'")
-    s = s.replace("\n", " ")
-    s = s.replace("­", "") 
-    s = re.sub(r' +', ' ', s)
-    s = s.strip()
-    return s
+def _wait_for_page(browser, html_path):
+    # the diff template sets diffReady once the page and its scripts load
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.common.exceptions import TimeoutException
+    try:
+        WebDriverWait(browser, config.get('render_timeout', 10), 0.1).until(
+            lambda b: b.execute_script("return window.diffReady === true"))
+    except TimeoutException:
+        logging.warning("timed out waiting for %s to load", html_path)
 
 
-def _equal(s1, s2):
-    return _fingerprint(s1) == _fingerprint(s2)
+def _remove_unused(artifacts):
+    # deletes the files of artifacts that are no longer in the index
+    for artifact in artifacts:
+        if not Artifact.select().where(Artifact.digest == artifact.digest).exists():
+            artifact_store.remove(artifact.digest, artifact.ext)
 
 
-punctuation = dict.fromkeys(i for i in range(sys.maxunicode) 
-        if unicodedata.category(chr(i)).startswith('P'))
+def _schedule_keys(url, feed_url):
+    keys = ["host:%s" % urlparse(url).netloc]
+    if feed_url:
+        keys.insert(0, "feed:%s" % feed_url)
+    return keys
 
 
-def _fingerprint(s):
-    # make sure the string has been normalized, bleach everything, remove all 
-    # whitespace and punctuation to create a psuedo fingerprint for the text 
-    # for use during compararison
-    s = _normal(s)
-    s = bleach.clean(s, tags=[], strip=True)
-    s = re.sub(r'\s+', '', s, flags=re.MULTILINE)
-    s = s.translate(punctuation)
-    return s
+def _dt(d):
+    return d.strftime("%Y-%m-%d %H:%M:%S")
 
 
 def _remove_utm(url):
@@ -697,15 +2420,67 @@ def _remove_utm(url):
     ])
 
 
-def _get(url):
-    return requests.get(url, timeout=60, headers={"User-Agent": UA})
+def _parse_shard(value):
+    try:
+        index, count = [int(n) for n in str(value).split("/")]
+    except ValueError:
+        raise ValueError("shard should look like 0/4, not %s" % value)
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("no shard %s" % value)
+    return index, count
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description='', formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("--home", help='Working directory', default=os.getcwd())
-    parser.add_argument('--rerun', help='Regenerates the most recent diff of the given entity')
+def _chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def _date(value):
+    return datetime.strptime(value, "%Y-%m-%d")
 
-    args = parser.parse_args()
-    main(args)
+
+def _rate_limit_reset(e):
+    # seconds until twitter's rate limit window resets, if it said
+    response = getattr(e, 'response', None)
+    reset = getattr(response, 'headers', {}).get('x-rate-limit-reset')
+    if reset and reset.isdigit():
+        return max(int(reset) - time.time(), 0)
+    return None
+
+
+def _content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+def _capture(resp, body=None, truncated=False):
+    # a broken archive shouldn't stop diffengine from working
+    try:
+        warc.write(resp, body, truncated)
+    except Exception as e:
+        logging.error("unable to write %s to warc: %s", resp.url, e)
+
+
+def _get(url, headers=None, stream=False, retry_status=True):
+    if session is None:
+        setup_session()
+    via = session if retry_status else outbox_session
+    host = urlparse(url).netloc
+    t = time.perf_counter()
+    try:
+        if stream:
+            resp = via.open(url, headers=headers)
+        else:
+            resp = via.get(url, headers=headers)
+    except Exception:
+        metrics.http_requests.inc(host=host, status="error")
+        raise
+    finally:
+        metrics.http_seconds.observe(time.perf_counter() - t, host=host)
+    metrics.http_requests.inc(host=host, status=resp.status_code)
+    if not stream:
+        metrics.http_bytes.observe(len(resp.content), host=host)
+    return resp
+
+
+if __name__ == "__main__":
+    main()
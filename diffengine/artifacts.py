@@ -0,0 +1,78 @@
+"""
+A content addressed store for the html and images of diffs. Files are
+named by the sha1 of what is in them and spread over two levels of
+directories by the start of it, so no one directory gets big, the same
+content is only ever kept once, and a backup only has to copy new files:
+
+    store = ArtifactStore("/home/ed/.diffengine/artifacts")
+    digest = store.put(data, ".jpg")
+    store.path(digest, ".jpg")  # .../artifacts/3f/a2/3fa2...jpg
+
+Files are written to a temporary name and renamed into place, so a file
+in the store is always whole. Screenshots are re-encoded with Pillow before
+they go in, since PhantomJS saves them as PNG whatever they are called.
+"""
+
+import io
+import os
+import hashlib
+import threading
+
+# the file extension for each format images can be stored in
+EXTENSIONS = {"jpeg": ".jpg", "webp": ".webp"}
+
+
+class ArtifactStore(object):
+
+    def __init__(self, root, depth=2):
+        self.root = root
+        self.depth = depth
+
+    def path(self, digest, ext):
+        shards = [digest[i * 2:i * 2 + 2] for i in range(self.depth)]
+        return os.path.join(self.root, *(shards + [digest + ext]))
+
+    def put(self, data, ext):
+        """
+        Stores data, unless the same data is stored already, and returns
+        its digest.
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.path(digest, ext)
+        if os.path.isfile(path):
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%s-%s.tmp" % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp, "wb") as fh:
+                fh.write(data)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp, path)
+        finally:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+        return digest
+
+    def remove(self, digest, ext):
+        try:
+            os.remove(self.path(digest, ext))
+        except FileNotFoundError:
+            pass
+
+
+def encode(path, fmt="jpeg", quality=80):
+    """
+    Returns the bytes of the image at path encoded as an optimized,
+    progressive JPEG, or as WebP.
+    """
+    from PIL import Image
+    with Image.open(path) as image:
+        image = image.convert("RGB")
+    out = io.BytesIO()
+    if fmt == "webp":
+        image.save(out, "WEBP", quality=quality, method=6)
+    else:
+        image.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+    return out.getvalue()
+
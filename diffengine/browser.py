@@ -0,0 +1,136 @@
+"""
+Long lived headless browsers for taking screenshots of diffs. Starting
+PhantomJS for every diff is slow and leaks processes, so a small pool of
+browsers is kept for the whole run and shared by a queue of screenshot
+jobs that runs alongside fetching.
+"""
+
+import queue
+import logging
+import threading
+
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class BrowserPool(object):
+
+    def __init__(self, executable="phantomjs", size=2, factory=None):
+        self.executable = executable
+        self.size = max(size, 1)
+        self.factory = factory or self._phantomjs
+        self.idle = queue.Queue()
+        self.started = []
+        self.lock = threading.Lock()
+
+    def _phantomjs(self):
+        from selenium import webdriver
+        logging.debug("starting browser %s", self.executable)
+        return webdriver.PhantomJS(self.executable)
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.started) < self.size:
+                b = self.factory()
+                self.started.append(b)
+                return b
+        return self.idle.get()
+
+    def release(self, b, broken=False):
+        if not broken:
+            self.idle.put(b)
+            return
+        # throw away browsers that errored, a new one is started on demand
+        with self.lock:
+            if b in self.started:
+                self.started.remove(b)
+        _quit(b)
+
+    @contextmanager
+    def browser(self):
+        b = self.acquire()
+        try:
+            yield b
+        except Exception:
+            self.release(b, broken=True)
+            raise
+        else:
+            self.release(b)
+
+    def close(self):
+        with self.lock:
+            browsers, self.started = self.started, []
+        for b in browsers:
+            _quit(b)
+        self.idle = queue.Queue()
+
+
+class ScreenshotQueue(object):
+    """
+    Takes screenshots of diffs in background threads, each one borrowing a
+    browser from the pool. With no workers screenshots are taken straight
+    away in the calling thread, and with no pool the diffs draw their own
+    images.
+    """
+
+    def __init__(self, pool, workers=2):
+        self.pool = pool
+        self.workers = workers
+        self.executor = None
+        self.pending = set()
+        self.lock = threading.Lock()
+        if workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, diff, html_path):
+        """
+        Queues up the screenshot and thumbnail for a diff whose html has
+        been written to html_path, and returns a future for them.
+        """
+        if not self.executor:
+            self._render(diff, html_path)
+            return None
+        future = self.executor.submit(self._render, diff, html_path)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _render(self, diff, html_path):
+        if self.pool is None:
+            diff.generate_diff_images(html_path)
+            return
+        with self.pool.browser() as b:
+            diff.generate_diff_images(html_path, browser=b)
+
+    def _done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+        if future.exception():
+            logging.error("unable to take screenshots: %s", future.exception())
+
+    def depth(self):
+        with self.lock:
+            return len(self.pending)
+
+    def join(self):
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=True)
+        if self.pool:
+            self.pool.close()
+
+
+def _quit(b):
+    try:
+        b.quit()
+    except Exception as e:
+        logging.warning("unable to quit browser: %s", e)
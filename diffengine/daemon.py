@@ -0,0 +1,102 @@
+"""
+Running diffengine as a long lived process instead of from cron. The config,
+database, browsers and worker pools are set up once and kept warm, feeds
+are refreshed every feed_interval seconds and entries are checked as soon
+as their next_check_at comes around.
+
+SIGTERM (or ctrl-c) finishes the work in hand and shuts down cleanly, and
+SIGHUP rereads config.yaml.
+"""
+
+import time
+import signal
+import logging
+import threading
+
+from datetime import datetime
+
+import diffengine
+
+
+class Daemon(object):
+
+    def __init__(self):
+        self.running = False
+        self.reload_requested = False
+        self.wakeup = threading.Event()
+        self.next_refresh = {}
+        self.options = {}
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.request_reload)
+
+    def stop(self, *args):
+        logging.info("stopping")
+        self.running = False
+        self.wakeup.set()
+
+    def request_reload(self, *args):
+        self.reload_requested = True
+        self.wakeup.set()
+
+    def run(self):
+        self.install_signal_handlers()
+        self.configure()
+        self.running = True
+        logging.info("running as a daemon")
+        while self.running:
+            if self.reload_requested:
+                self.reload_requested = False
+                diffengine.reload()
+                self.configure()
+            try:
+                self.tick()
+            except Exception:
+                logging.exception("unexpected error, carrying on")
+            if self.running:
+                self.sleep()
+        logging.info("daemon stopped")
+
+    def configure(self):
+        config = diffengine.config
+        self.feeds = diffengine.shard_feeds(config.get('feeds', []))
+        self.feed_interval = config.get('feed_interval', 300)
+        self.max_sleep = config.get('max_sleep', 60)
+        self.budget = config.get('budget', 1000)
+        self.options = dict((f['url'], diffengine.feed_options(f)) for f in self.feeds)
+        # feeds that were added get refreshed straight away
+        urls = set(self.options)
+        self.next_refresh = dict((url, t) for url, t in self.next_refresh.items() if url in urls)
+
+    def tick(self):
+        """
+        Refreshes the feeds that are due and then checks the entries that
+        are due. Returns the number of entries that were checked.
+        """
+        now = time.time()
+        due = [f for f in self.feeds if self.next_refresh.get(f['url'], 0) <= now]
+        if due:
+            diffengine.refresh_feeds(due)
+            for f in due:
+                self.next_refresh[f['url']] = now + self.feed_interval
+        if not self.options:
+            return 0
+        return diffengine.check_due(self.options, self.budget)
+
+    def seconds_until_due(self):
+        now = time.time()
+        waits = [t - now for t in self.next_refresh.values()]
+        if self.options:
+            next_check = diffengine.next_due(list(self.options))
+            if next_check:
+                waits.append((next_check - datetime.utcnow()).total_seconds())
+        return min(waits + [self.max_sleep])
+
+    def sleep(self):
+        wait = max(self.seconds_until_due(), 1)
+        logging.debug("sleeping for %.1f seconds", wait)
+        self.wakeup.wait(wait)
+        self.wakeup.clear()
@@ -0,0 +1,38 @@
+"""
+Compact deltas between two versions of a summary. The summaries are split
+into words and whitespace, and the delta is a list of operations that
+either copy a run of tokens from the old summary or add new text. The
+operations are stored as zlib compressed JSON.
+"""
+
+import re
+import json
+import zlib
+
+from difflib import SequenceMatcher
+
+_tokens = re.compile(r'(\s+)')
+
+
+def encode(old, new):
+    a = _tokens.split(old)
+    b = _tokens.split(new)
+    ops = []
+    matcher = SequenceMatcher(None, a, b, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(b[j1:j2]))
+    return zlib.compress(json.dumps(ops, separators=(',', ':')).encode('utf8'))
+
+
+def apply(old, delta):
+    a = _tokens.split(old)
+    parts = []
+    for op in json.loads(zlib.decompress(delta).decode('utf8')):
+        if isinstance(op, list):
+            parts.append(''.join(a[op[0]:op[1]]))
+        else:
+            parts.append(op)
+    return ''.join(parts)
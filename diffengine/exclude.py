@@ -0,0 +1,81 @@
+"""
+Exclusion rules take volatile boilerplate out of summaries before they are
+fingerprinted: timestamps, view counters, "related stories" boxes, ad
+slugs and the like. Text that an exclusion rule matches is never stored,
+so it can't create a new version, a diff or a tweet when it changes.
+
+Rules are regular expressions, listed for every feed under exclude in
+config.yaml, and for a single feed under that feed's exclude:
+
+    exclude:
+      - 'Last updated[^<]*'
+    feeds:
+      - name: Example
+        url: https://example.com/feed
+        exclude:
+          - '<p>Related:.*?</p>'
+          - '(?i)\\d+ views'
+
+They are matched against the summary after readability and bleach, which
+leaves just <p> tags and single spaces.
+"""
+
+import re
+
+from functools import lru_cache
+
+# used when the config doesn't list any, these cover what diffengine
+# used to ignore when validating a diff
+DEFAULT_RULES = (
+    r'<p>(?:\* )?Comments\b[^<]*</p>',
+    r'Last updated[^<]*',
+)
+
+_global_flags = re.compile(r'^\(\?([aiLmsux]+)\)')
+_empty = re.compile(r'<p>\s*</p>')
+_spaces = re.compile(r' +')
+_edges = re.compile(r' ?(</?p>) ?')
+
+
+def rules_for(config, feed_config):
+    """
+    Returns the rules that apply to a feed, its own followed by the ones
+    for every feed.
+    """
+    rules = list(feed_config.get('exclude') or [])
+    rules.extend(config.get('exclude', DEFAULT_RULES) or [])
+    return tuple(rules)
+
+
+@lru_cache(maxsize=128)
+def compile_rules(rules):
+    """
+    Compiles a tuple of rules into one pattern that matches any of them, or
+    None if there are no rules. A flag like (?i) at the start of a rule
+    only applies to that rule.
+    """
+    parts = []
+    for rule in rules:
+        m = _global_flags.match(rule)
+        if m:
+            parts.append("(?%s:%s)" % (m.group(1), rule[m.end():]))
+        else:
+            parts.append("(?:%s)" % rule)
+    if not parts:
+        return None
+    return re.compile("|".join(parts))
+
+
+def apply(pattern, summary):
+    """
+    Returns the summary with whatever the pattern matches taken out.
+    """
+    if pattern is None:
+        return summary
+    s = pattern.sub('', summary)
+    if s == summary:
+        return summary
+    s = _empty.sub('', s)
+    s = _spaces.sub(' ', s)
+    s = _edges.sub(r'\1', s)
+    return s.strip()
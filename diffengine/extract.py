@@ -0,0 +1,123 @@
+"""
+Turning fetched html into the title, summary and fingerprint that versions
+are compared with. Readability and bleach are the most CPU hungry part of
+checking an entry, so the Extractor can run them in a pool of processes
+while the fetching carries on.
+"""
+
+import re
+import signal
+import hashlib
+import threading
+
+from concurrent.futures import Future
+from multiprocessing import get_context
+
+from diffengine import exclude as exclusions
+from diffengine.punctuation import pattern as punctuation
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+
+def extract(html, timeout=None, exclude=None):
+    """
+    Returns (title, summary, fingerprint) for a page of html. When a timeout
+    is given, and the platform supports it, ExtractionTimeout is raised if
+    readability takes longer than that many seconds; the alarm can only be
+    set from the main thread, so elsewhere the timeout is ignored. Whatever
+    the compiled exclude pattern matches is taken out of the summary before
+    it is fingerprinted.
+    """
+    import bleach
+    import readability
+
+    use_alarm = (timeout and hasattr(signal, "SIGALRM") and
+                 threading.current_thread() is threading.main_thread())
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _timed_out)
+        signal.alarm(int(timeout))
+    try:
+        doc = readability.Document(html)
+        title = doc.title()
+        summary = doc.summary(html_partial=True)
+        summary = bleach.clean(summary, tags=["p"], strip=True)
+        summary = exclusions.apply(exclude, _normal(summary))
+        return title, summary, _digest(summary)
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+
+
+def _timed_out(signum, frame):
+    raise ExtractionTimeout()
+
+
+class Extractor(object):
+    """
+    Runs extract in a pool of worker processes, or straight away in the
+    calling thread when there are no workers.
+    """
+
+    def __init__(self, workers=0, timeout=30):
+        self.workers = workers
+        self.timeout = timeout
+        self.pool = None
+        if workers > 0:
+            # spawn rather than fork, the parent has fetching threads running
+            self.pool = get_context("spawn").Pool(workers)
+
+    def submit(self, html, exclude=None):
+        """
+        Returns a Future for the (title, summary, fingerprint) of html, so
+        that it can be waited on alongside the fetches.
+        """
+        future = Future()
+        if self.pool:
+            self.pool.apply_async(extract, (html, self.timeout, exclude),
+                                  callback=future.set_result,
+                                  error_callback=future.set_exception)
+            return future
+        try:
+            future.set_result(extract(html, self.timeout, exclude))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+
+
+def _normal(s):
+    # additional normalizations for readability + bleached text
+    s = s.replace("\xa0", " ")
+    s = s.replace('“', '"')
+    s = s.replace('”', '"')
+    s = s.replace("’", "'")
+    s = s.replace("\n", " ")
+    s = s.replace("­", "")
+    s = re.sub(r' +', ' ', s)
+    s = s.strip()
+    return s
+
+
+def _equal(s1, s2):
+    return _fingerprint(s1) == _fingerprint(s2)
+
+
+def _fingerprint(s):
+    # make sure the string has been normalized, bleach everything, remove all
+    # whitespace and punctuation to create a psuedo fingerprint for the text
+    # for use during compararison
+    import bleach
+    s = _normal(s)
+    s = bleach.clean(s, tags=[], strip=True)
+    s = re.sub(r'\s+', '', s, flags=re.MULTILINE)
+    s = punctuation.sub('', s)
+    return s
+
+
+def _digest(s):
+    return hashlib.sha1(_fingerprint(s).encode("utf8")).hexdigest()
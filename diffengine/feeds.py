@@ -0,0 +1,152 @@
+"""
+Reading the links out of RSS, Atom and RDF feeds, and XML sitemaps like
+the ones Google News reads, as the bytes arrive. Each item is thrown away
+once its link has been read, so a feed that is tens of megabytes takes no
+more memory than a small one, and reading can stop as soon as the caller
+has seen enough:
+
+    reader = FeedReader(resp.iter_content(64 * 1024))
+    for link in reader:
+        ...
+
+XMLPullParser only accepts well formed XML, so a feed that it gives up on
+is handed to feedparser instead, which copes with most things, as long as
+it is no bigger than buffer_size.
+"""
+
+import logging
+
+from collections import Counter
+from xml.etree.ElementTree import XMLPullParser, ParseError
+
+# the root element of each kind of feed, and the element that holds one
+# item in it
+KINDS = {
+    "rss": ("rss", "item"),
+    "RDF": ("rdf", "item"),
+    "feed": ("atom", "entry"),
+    "urlset": ("sitemap", "url"),
+    "sitemapindex": ("sitemapindex", None),
+}
+
+
+class FeedReader(object):
+    """
+    Iterates over the links in a feed given as an iterable of byte chunks.
+    Once it has been read to the end complete is True.
+    """
+
+    def __init__(self, chunks, buffer_size=10 * 1024 * 1024):
+        self.chunks = iter(chunks)
+        self.buffer_size = buffer_size
+        self.kind = None
+        self.item = None
+        self.size = 0
+        self.complete = False
+
+    def __iter__(self):
+        parser = XMLPullParser(events=("start", "end"))
+        # the body so far, in case it has to go to feedparser, until it
+        # gets too big to keep
+        buffered = []
+        stack = []
+        # the links yielded before any parse error, which feedparser will
+        # find again
+        yielded = Counter()
+        try:
+            for chunk in self._read(buffered):
+                parser.feed(chunk)
+                for link in self._links(parser, stack):
+                    yielded[link] += 1
+                    yield link
+            parser.close()
+            for link in self._links(parser, stack):
+                yield link
+        except ParseError as e:
+            for chunk in self._read(buffered):
+                pass
+            if not buffered:
+                raise
+            logging.warning("feed isn't well formed xml, using feedparser: %s", e)
+            for link in _feedparser_links(b"".join(buffered)):
+                if yielded[link] > 0:
+                    yielded[link] -= 1
+                    continue
+                yield link
+        self.complete = True
+        if self.kind == "sitemapindex":
+            logging.warning("sitemap indexes aren't supported, add the sitemaps "
+                            "they list as feeds instead")
+
+    def _read(self, buffered):
+        for chunk in self.chunks:
+            self.size += len(chunk)
+            if self.size <= self.buffer_size:
+                buffered.append(chunk)
+            elif buffered:
+                del buffered[:]
+            yield chunk
+
+    def _links(self, parser, stack):
+        for event, elem in parser.read_events():
+            if event == "start":
+                if self.kind is None:
+                    self.kind, self.item = KINDS.get(_local(elem.tag), ("unknown", None))
+                stack.append(elem)
+                continue
+            stack.pop()
+            if _local(elem.tag) != self.item or not stack:
+                continue
+            link = _link(self.kind, elem)
+            # done with the item, so let it go
+            stack[-1].remove(elem)
+            if link:
+                yield link
+
+
+def _link(kind, item):
+    if kind == "atom":
+        for child in item:
+            if _local(child.tag) == "link" and child.get("rel", "alternate") == "alternate":
+                return child.get("href")
+        return None
+    if kind == "sitemap":
+        return _text(item, "loc")
+    link = _text(item, "link")
+    if link:
+        return link
+    if kind == "rdf":
+        return _attribute(item, "about")
+    # a guid can stand in for the link unless it says it isn't a url
+    for child in item:
+        if _local(child.tag) == "guid" and child.get("isPermaLink") != "false":
+            guid = (child.text or "").strip()
+            if guid.startswith("http"):
+                return guid
+    return None
+
+
+def _text(elem, name):
+    for child in elem:
+        if _local(child.tag) == name and child.text and child.text.strip():
+            return child.text.strip()
+    return None
+
+
+def _attribute(elem, name):
+    for key, value in elem.attrib.items():
+        if _local(key) == name:
+            return value
+    return None
+
+
+def _local(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _feedparser_links(body):
+    import feedparser
+    for entry in feedparser.parse(body).entries:
+        link = entry.get("link")
+        if link:
+            yield link
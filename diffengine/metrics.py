@@ -0,0 +1,297 @@
+"""
+Counters, gauges and histograms for each stage of checking feeds, so that a
+slow run can be pinned on the network, readability, PhantomJS or SQLite.
+They are kept in memory for the life of the process and can be written in
+the Prometheus text format to a file (for node_exporter's textfile
+collector), served over HTTP, or printed as a per-run profile.
+
+    with metrics.timer(metrics.diff_seconds):
+        ...
+    metrics.http_requests.inc(host="example.com", status="200")
+"""
+
+import os
+import time
+import bisect
+import threading
+
+from contextlib import contextmanager
+
+# seconds, from a quick database query up to a slow page or screenshot
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                10, 30, 60)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(l, "")) for l in self.labels)
+
+    def samples(self):
+        """
+        Returns (suffix, label values, extra labels, value) for every
+        value that has been recorded.
+        """
+        with self.lock:
+            return [("", key, (), value) for key, value in sorted(self.values.items())]
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. When given a function the gauge reads
+    it whenever the metrics are rendered, which suits queue depths.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        super(Gauge, self).__init__(name, help, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def samples(self):
+        if self.function:
+            try:
+                return [("", (), (), self.function())]
+            except Exception:
+                return []
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            h = self.values.get(key)
+            if h is None:
+                h = self.values[key] = {"counts": [0] * (len(self.buckets) + 1),
+                                        "sum": 0.0, "count": 0, "max": 0.0}
+            h["counts"][i] += 1
+            h["sum"] += value
+            h["count"] += 1
+            h["max"] = max(h["max"], value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = sorted(self.values.items())
+            for key, h in items:
+                total = 0
+                for bound, count in zip(self.buckets + ("+Inf",), h["counts"]):
+                    total += count
+                    samples.append(("_bucket", key, (("le", _number(bound)),), total))
+                samples.append(("_sum", key, (), h["sum"]))
+                samples.append(("_count", key, (), h["count"]))
+        return samples
+
+    def summary(self):
+        """
+        Returns (label values, count, sum, max) for each set of labels.
+        """
+        with self.lock:
+            return [(key, h["count"], h["sum"], h["max"])
+                    for key, h in sorted(self.values.items())]
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self.add(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def get(self, name):
+        for metric in self.metrics:
+            if metric.name == name:
+                return metric
+        return None
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+    def render(self):
+        """
+        Returns all of the metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for suffix, key, extra, value in metric.samples():
+                pairs = list(zip(metric.labels, key)) + list(extra)
+                labels = ",".join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+                if labels:
+                    labels = "{%s}" % labels
+                lines.append("%s%s%s %s" % (metric.name, suffix, labels, _number(value)))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # write and rename, so a scraper never reads half a file
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp, "w") as fh:
+            fh.write(self.render())
+        os.replace(tmp, path)
+
+    def profile(self):
+        """
+        Returns a table of where the time went, slowest stage first,
+        followed by the counters.
+        """
+        rows = []
+        for metric in self.metrics:
+            if isinstance(metric, Histogram) and metric.name.endswith("_seconds"):
+                for key, count, total, biggest in metric.summary():
+                    rows.append((total, _label(metric, key), count, biggest))
+        rows.sort(reverse=True)
+        lines = ["%-60s %8s %10s %10s %10s" % ("stage", "count", "total s", "mean s", "max s")]
+        for total, name, count, biggest in rows:
+            lines.append("%-60s %8d %10.3f %10.4f %10.3f" %
+                         (name, count, total, total / count, biggest))
+        lines.append("")
+        for metric in self.metrics:
+            if isinstance(metric, Counter):
+                for suffix, key, extra, value in metric.samples():
+                    lines.append("%-60s %8s" % (_label(metric, key), _number(value)))
+        return "\n".join(lines) + "\n"
+
+
+class Server(object):
+    """
+    Serves the metrics at /metrics from a background thread.
+    """
+
+    def __init__(self, registry, port, host=""):
+        from socketserver import ThreadingMixIn
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+
+        class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@contextmanager
+def timer(histogram, **labels):
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - t, **labels)
+
+
+def _label(metric, key):
+    if not metric.labels:
+        return metric.name
+    return "%s{%s}" % (metric.name, ",".join("%s=%s" % p for p in zip(metric.labels, key)))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+registry = Registry()
+
+http_seconds = registry.histogram(
+    "diffengine_http_request_seconds", "Time taken by HTTP requests", ["host"])
+http_bytes = registry.histogram(
+    "diffengine_http_response_bytes", "Size of HTTP responses", ["host"],
+    buckets=SIZE_BUCKETS)
+http_requests = registry.counter(
+    "diffengine_http_requests_total", "HTTP requests made", ["host", "status"])
+feed_seconds = registry.histogram(
+    "diffengine_feed_refresh_seconds", "Time taken to refresh a feed")
+extract_seconds = registry.histogram(
+    "diffengine_extract_seconds",
+    "Time from handing a page to the extractor to getting its summary back")
+diff_seconds = registry.histogram(
+    "diffengine_diff_seconds", "Time taken to diff two versions")
+screenshot_seconds = registry.histogram(
+    "diffengine_screenshot_seconds", "Time taken to screenshot a diff")
+db_seconds = registry.histogram(
+    "diffengine_db_seconds", "Time taken by database queries", ["statement"])
+outbox_seconds = registry.histogram(
+    "diffengine_outbox_job_seconds", "Time taken by outbox jobs", ["kind"])
+outbox_jobs = registry.counter(
+    "diffengine_outbox_jobs_total", "Outbox jobs run", ["kind", "outcome"])
+entries_checked = registry.counter(
+    "diffengine_entries_checked_total", "Entries checked")
+new_versions = registry.counter(
+    "diffengine_versions_total", "New versions found")
+diffs = registry.counter(
+    "diffengine_diffs_total", "Diffs generated")
+pages_pending = registry.gauge(
+    "diffengine_pages_pending", "Pages being fetched or extracted")
+run_seconds = registry.histogram(
+    "diffengine_run_seconds", "Time taken to check the entries that were due")
@@ -0,0 +1,212 @@
+"""
+Publishing to the outside world, archiving versions at the Wayback Machine
+and tweeting diffs, goes through an outbox of jobs kept in the database.
+Those services can be slow, or busy, or tell us to back off for a while,
+and none of that should hold up checking entries for changes. Jobs are
+worked through by background threads, retried with exponential backoff
+when they fail, and survive a restart because they are in the database.
+
+A job is claimed by bumping its attempts and pushing its run_at out by a
+lease, so a job whose worker died is picked up again once the lease runs
+out, and two workers can never both claim the same attempt.
+"""
+
+import time
+import logging
+import threading
+
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timedelta, timezone
+
+from diffengine import metrics
+
+
+class RateLimited(Exception):
+    """
+    Raised by a job when the service it talks to says to slow down. Jobs
+    of the same kind are put on hold for retry_after seconds, or the
+    outbox's backoff if that is longer, and the attempt doesn't count
+    towards the job failing.
+    """
+
+    def __init__(self, retry_after=None, message="rate limited"):
+        super(RateLimited, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class Outbox(object):
+
+    def __init__(self, model, workers=1, max_attempts=5, backoff=60,
+                 max_backoff=3600, lease=300, poll=5):
+        self.model = model
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self.poll = poll
+        # kind -> datetime that jobs of that kind are on hold until
+        self.paused = {}
+        self.busy = 0
+        self.lock = threading.Condition()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name="outbox-%s" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def put(self, kind, **kwargs):
+        """
+        Adds a job to the outbox and lets the workers know about it.
+        """
+        job = self.model.create(kind=kind, **kwargs)
+        logging.debug("queued %s job %s", kind, job.id)
+        self.wakeup.set()
+        return job
+
+    def claim(self):
+        """
+        Returns the next job that is due, now belonging to the caller, or
+        None if there isn't one.
+        """
+        Job = self.model
+        now = datetime.utcnow()
+        paused = [k for k, until in list(self.paused.items()) if until > now]
+        query = (Job.select()
+                 .where(Job.state << ['pending', 'running'], Job.run_at <= now)
+                 .order_by(Job.run_at)
+                 .limit(10))
+        if paused:
+            query = query.where(~(Job.kind << paused))
+        for job in list(query):
+            lease_until = now + timedelta(seconds=self.lease)
+            claimed = (Job.update(state='running', run_at=lease_until,
+                                  attempts=Job.attempts + 1)
+                       .where(Job.id == job.id, Job.attempts == job.attempts)
+                       .execute())
+            if claimed:
+                job.state = 'running'
+                job.run_at = lease_until
+                job.attempts += 1
+                return job
+        return None
+
+    def run(self, job):
+        Job = self.model
+        now = datetime.utcnow()
+        t = time.perf_counter()
+        try:
+            job.perform()
+        except RateLimited as e:
+            metrics.outbox_jobs.inc(kind=job.kind, outcome="rate_limited")
+            # a Retry-After of 0, or a reset that has already gone by,
+            # mustn't have the job claimed and sent again straight away
+            wait = max(e.retry_after or 0, self.backoff, 1)
+            until = now + timedelta(seconds=wait)
+            self.paused[job.kind] = until
+            logging.warning("%s rate limited, holding %s jobs for %ss",
+                            job.kind, job.kind, wait)
+            self._update(job, state='pending', run_at=until,
+                         attempts=Job.attempts - 1)
+        except Exception as e:
+            metrics.outbox_jobs.inc(kind=job.kind, outcome="error")
+            if job.attempts >= self.max_attempts:
+                logging.error("giving up on %s job %s after %s attempts: %s",
+                              job.kind, job.id, job.attempts, e)
+                self._update(job, state='failed', finished=now, error=str(e))
+            else:
+                wait = min(self.backoff * 2 ** (job.attempts - 1), self.max_backoff)
+                logging.warning("%s job %s failed, retrying in %ss: %s",
+                                job.kind, job.id, wait, e)
+                self._update(job, state='pending', error=str(e),
+                             run_at=now + timedelta(seconds=wait))
+        else:
+            metrics.outbox_jobs.inc(kind=job.kind, outcome="done")
+            self._update(job, state='done', finished=datetime.utcnow())
+        finally:
+            metrics.outbox_seconds.observe(time.perf_counter() - t, kind=job.kind)
+
+    def run_next(self):
+        """
+        Runs the next job that is due in the calling thread, and returns
+        False if there wasn't one.
+        """
+        with self.lock:
+            self.busy += 1
+        try:
+            job = self.claim()
+            if job is None:
+                return False
+            self.run(job)
+            return True
+        finally:
+            with self.lock:
+                self.busy -= 1
+                self.lock.notify_all()
+
+    def drain(self, timeout=None):
+        """
+        Works through the jobs that are due, alongside the workers, and
+        waits for the ones in hand to finish. Jobs that are waiting to be
+        retried are left for later. Returns False if timeout seconds went
+        by first.
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        while self.run_next():
+            if deadline and time.monotonic() > deadline:
+                return False
+        with self.lock:
+            while self.busy:
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def depth(self):
+        Job = self.model
+        return Job.select().where(Job.state << ['pending', 'running']).count()
+
+    def close(self):
+        self.stopping.set()
+        self.wakeup.set()
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def _update(self, job, **fields):
+        Job = self.model
+        Job.update(**fields).where(Job.id == job.id).execute()
+
+    def _work(self):
+        while not self.stopping.is_set():
+            try:
+                if self.run_next():
+                    continue
+            except Exception:
+                logging.exception("outbox worker error")
+            self.wakeup.wait(self.poll)
+            self.wakeup.clear()
+
+
+def retry_after(value, default=None):
+    """
+    Turns a Retry-After header, which is either a number of seconds or an
+    http date, into seconds.
+    """
+    if not value:
+        return default
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0)
@@ -0,0 +1,240 @@
+"""
+Diffing versions a paragraph at a time. Most edits to a news story touch a
+sentence or two, so rather than word diffing the whole of both versions
+they are split into paragraphs, the paragraphs that are the same in both
+are lined up, and only the ones in between get a word level diff.
+
+Paragraphs are compared by their text with tags stripped and whitespace
+collapsed, so changes to markup alone don't count as changes. They are
+lined up by trimming what is the same at the start and the end, and then
+anchoring on paragraphs that appear exactly once in each version, which
+keeps it close to linear in the length of the article.
+
+    changes = compare(old.html, new.html)
+    if changes.changed:
+        html = changes.render()
+"""
+
+import re
+import bisect
+
+from difflib import SequenceMatcher
+
+_block_end = re.compile(r'</(?:p|h1)>', re.IGNORECASE)
+_block = re.compile(r'^(\s*<(\w+)[^>]*>)(.*)(</\2>\s*)$', re.DOTALL)
+_tags = re.compile(r'<[^>]*>')
+_tokens = re.compile(r'<[^>]*>|[^\s<]+\s*|\s+')
+
+
+class Changes(object):
+    """
+    The paragraphs of two versions lined up: a list of ('equal', block)
+    and ('change', old blocks, new blocks) operations.
+    """
+
+    def __init__(self, ops):
+        self.ops = ops
+        self._rendered = None
+
+    @property
+    def changed(self):
+        return any(op[0] == 'change' for op in self.ops)
+
+    def rendered_changes(self):
+        """
+        Returns the html for each changed run of paragraphs, with the
+        words that changed marked up with ins and del.
+        """
+        if self._rendered is None:
+            self._rendered = [render_change(op[1], op[2])
+                              for op in self.ops if op[0] == 'change']
+        return self._rendered
+
+    def render(self, wrapper_element='div', wrapper_class='diff'):
+        """
+        Returns the whole diff, unchanged paragraphs and all.
+        """
+        changes = iter(self.rendered_changes())
+        parts = []
+        for op in self.ops:
+            if op[0] == 'equal':
+                parts.append(op[1])
+            else:
+                parts.append(next(changes))
+        return '<%s class="%s">%s</%s>' % (wrapper_element, wrapper_class,
+                                           ''.join(parts), wrapper_element)
+
+
+def compare(old_html, new_html):
+    a = split(old_html)
+    b = split(new_html)
+    ka = [key(block) for block in a]
+    kb = [key(block) for block in b]
+    ops = []
+    i = j = 0
+    for mi, mj in match(ka, kb) + [(len(a), len(b))]:
+        if mi > i or mj > j:
+            ops.append(('change', a[i:mi], b[j:mj]))
+        if mi < len(a):
+            # the new version's markup wins when only the markup differs
+            ops.append(('equal', b[mj]))
+        i, j = mi + 1, mj + 1
+    return Changes(ops)
+
+
+def split(html):
+    blocks = []
+    start = 0
+    for m in _block_end.finditer(html):
+        blocks.append(html[start:m.end()])
+        start = m.end()
+    if start < len(html):
+        blocks.append(html[start:])
+    return blocks
+
+
+def key(block):
+    return ' '.join(_tags.sub(' ', block).split())
+
+
+def match(a, b):
+    """
+    Returns the (i, j) pairs of positions where a[i] == b[j] that line the
+    two lists up, in order.
+    """
+    matches = []
+    _match(a, 0, len(a), b, 0, len(b), matches)
+    return matches
+
+
+def _match(a, alo, ahi, b, blo, bhi, matches):
+    # the same at the start
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        matches.append((alo, blo))
+        alo += 1
+        blo += 1
+
+    # the same at the end, added once the middle has been matched
+    tail = []
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+        tail.append((ahi, bhi))
+
+    anchors = _anchors(a, alo, ahi, b, blo, bhi)
+    i, j = alo, blo
+    for ai, bj in anchors:
+        _match(a, i, ai, b, j, bj, matches)
+        matches.append((ai, bj))
+        i, j = ai + 1, bj + 1
+    if anchors:
+        _match(a, i, ahi, b, j, bhi, matches)
+
+    matches.extend(reversed(tail))
+
+
+def _anchors(a, alo, ahi, b, blo, bhi):
+    # paragraphs that appear once on each side, kept to the longest run
+    # that is in the same order on both (patience sorting)
+    in_a = {}
+    for i in range(alo, ahi):
+        in_a[a[i]] = None if a[i] in in_a else i
+    in_b = {}
+    for j in range(blo, bhi):
+        if in_a.get(b[j]) is not None:
+            in_b[b[j]] = None if b[j] in in_b else j
+    pairs = sorted((in_a[k], j) for k, j in in_b.items() if j is not None)
+
+    # longest increasing subsequence of the new positions
+    tails = []
+    links = []
+    back = {}
+    for i, j in pairs:
+        k = bisect.bisect_left(tails, j)
+        if k == len(tails):
+            tails.append(j)
+            links.append((i, j))
+        else:
+            tails[k] = j
+            links[k] = (i, j)
+        back[(i, j)] = links[k - 1] if k else None
+    result = []
+    node = links[-1] if links else None
+    while node:
+        result.append(node)
+        node = back[node]
+    return list(reversed(result))
+
+
+def render_change(old_blocks, new_blocks):
+    """
+    Returns html for a run of paragraphs that changed. Paragraphs are
+    paired up in order and word diffed, and any left over were deleted
+    or inserted outright.
+    """
+    parts = []
+    for n in range(max(len(old_blocks), len(new_blocks))):
+        old = old_blocks[n] if n < len(old_blocks) else None
+        new = new_blocks[n] if n < len(new_blocks) else None
+        parts.append(_render_pair(old, new))
+    return ''.join(parts)
+
+
+def _render_pair(old, new):
+    if old is None:
+        return _wrap_block(new, 'ins')
+    if new is None:
+        return _wrap_block(old, 'del')
+    om = _block.match(old)
+    nm = _block.match(new)
+    if om and nm and om.group(2).lower() == nm.group(2).lower():
+        return nm.group(1) + words(om.group(3), nm.group(3)) + nm.group(4)
+    return _wrap_block(old, 'del') + _wrap_block(new, 'ins')
+
+
+def _wrap_block(block, tag):
+    m = _block.match(block)
+    if m:
+        return '%s<%s>%s</%s>%s' % (m.group(1), tag, m.group(3), tag, m.group(4))
+    return '<%s>%s</%s>' % (tag, block, tag)
+
+
+def words(old, new):
+    """
+    Returns new with the words that were taken out of old marked up with
+    del and the ones that were added marked up with ins.
+    """
+    a = _tokens.findall(old)
+    b = _tokens.findall(new)
+    matcher = SequenceMatcher(None, [_token_key(t) for t in a],
+                              [_token_key(t) for t in b], autojunk=False)
+    parts = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            text = ''.join(b[j1:j2])
+            # the last word of new has no space after it, but if words of
+            # old are taken out after it they need the space they had
+            if i2 < len(a) and not text[-1:].isspace():
+                text += a[i2 - 1][len(a[i2 - 1].rstrip()):]
+            parts.append(text)
+            continue
+        deleted = ''.join(a[i1:i2])
+        inserted = ''.join(b[j1:j2])
+        if key(deleted):
+            parts.append(_wrap_words(deleted, 'del'))
+        if key(inserted):
+            parts.append(_wrap_words(inserted, 'ins'))
+        else:
+            # changes to markup or spacing alone keep the new version's
+            parts.append(inserted)
+    return ''.join(parts)
+
+
+def _wrap_words(text, tag):
+    # keep trailing whitespace outside so the markup hugs the words
+    stripped = text.rstrip()
+    return '<%s>%s</%s>%s' % (tag, stripped, tag, text[len(stripped):])
+
+
+def _token_key(token):
+    return token.strip() or ' '
@@ -0,0 +1,221 @@
+"""
+Turning a diff into the html page that is saved and the images of it that
+are tweeted. The page template is compiled once and kept for the life of
+the process, and has no assets to load from elsewhere, so a browser can
+render it without network access.
+
+Images are normally screenshots taken by PhantomJS (see browser.py), but
+with renderer set to pillow they are drawn here instead, which needs no
+browser at all. The drawing only knows about paragraphs and ins and del,
+which is all that a diff has in it:
+
+    draw_diff("diffs/2017-01-01/1.html", "1.jpg", "1-thumb.jpg")
+"""
+
+import os
+
+from functools import lru_cache
+from html.parser import HTMLParser
+
+TEMPLATE = "diff_template.html"
+
+SCREENSHOT_WIDTH = 1400
+SCREENSHOT_HEIGHT = 1000
+THUMBNAIL_WIDTH = 800
+THUMBNAIL_HEIGHT = 400
+
+# to match the template: 15pt text and a 10% margin
+FONT_SIZE = 20
+MARGIN = 0.1
+LINE_SPACING = 1.4
+HEADER_COLOR = "#eeeeee"
+BORDER_COLOR = "#dddddd"
+TEXT_COLOR = "black"
+LINK_COLOR = "#0000ee"
+COLORS = {"ins": "lightgreen", "del": "pink"}
+
+_blocks = {"p", "h1", "h2", "h3", "h4", "h5", "h6", "div", "li", "blockquote"}
+_hidden = {"head", "script", "style", "title"}
+
+
+@lru_cache(maxsize=1)
+def environment():
+    import jinja2
+    loader = jinja2.FileSystemLoader(os.path.dirname(os.path.abspath(__file__)))
+    return jinja2.Environment(loader=loader, auto_reload=False)
+
+
+def page(**context):
+    """
+    Returns the html page for a diff, given the title, url, old_time,
+    new_time and diff to fill in the template with.
+    """
+    return environment().get_template(TEMPLATE).render(**context)
+
+
+class _Parser(HTMLParser):
+    """
+    Collects the paragraphs of a diff page as lists of (text, style) runs,
+    where style is ins, del or None, along with the url in its header.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.paragraphs = []
+        self.url = None
+        self.current = []
+        self.styles = []
+        self.hidden = 0
+        self.header = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _hidden:
+            self.hidden += 1
+        elif tag == "header":
+            self.header += 1
+        elif tag in ("ins", "del"):
+            self.styles.append(tag)
+        elif tag in _blocks:
+            self.flush()
+
+    def handle_endtag(self, tag):
+        if tag in _hidden:
+            self.hidden = max(self.hidden - 1, 0)
+        elif tag == "header":
+            self.header = max(self.header - 1, 0)
+        elif tag in ("ins", "del"):
+            if tag in self.styles:
+                del self.styles[len(self.styles) - 1 - self.styles[::-1].index(tag)]
+        elif tag in _blocks:
+            self.flush()
+
+    def handle_data(self, data):
+        if self.hidden:
+            return
+        if self.header:
+            if data.strip():
+                self.url = data.strip()
+            return
+        style = self.styles[-1] if self.styles else None
+        if self.current and self.current[-1][1] == style:
+            self.current[-1] = (self.current[-1][0] + data, style)
+        else:
+            self.current.append((data, style))
+
+    def flush(self):
+        if "".join(text for text, style in self.current).strip():
+            self.paragraphs.append(self.current)
+        self.current = []
+
+    def close(self):
+        HTMLParser.close(self)
+        self.flush()
+
+
+def parse(html):
+    """
+    Returns (url, paragraphs) for a diff page, where each paragraph is a
+    list of (text, style) runs.
+    """
+    parser = _Parser()
+    parser.feed(html)
+    parser.close()
+    return parser.url, parser.paragraphs
+
+
+def clip(paragraphs):
+    """
+    Picks out the paragraph with the most changed text, and the ones either
+    side of it, the way the template's clip() does for screenshots. All of
+    the paragraphs are returned if none of them changed.
+    """
+    best = None
+    largest = 0
+    for i, runs in enumerate(paragraphs):
+        changed = sum(len(text) for text, style in runs if style)
+        if changed > largest:
+            best, largest = i, changed
+    if best is None:
+        return paragraphs
+    return paragraphs[max(best - 1, 0):best + 2]
+
+
+def draw(paragraphs, width, min_height, url=None, font=None):
+    """
+    Returns a Pillow image of the paragraphs, width wide and at least
+    min_height tall, with a header showing the url if there is one.
+    """
+    from PIL import Image, ImageDraw
+
+    font = font or load_font()
+    line_height = int(FONT_SIZE * LINE_SPACING)
+    margin = int(width * MARGIN)
+    header_height = line_height + 20 if url else 0
+
+    # lay out every word first, so the image can be made tall enough
+    words = []
+    x = margin
+    y = header_height + margin
+    space = font.getlength(" ")
+    for runs in paragraphs:
+        x = margin
+        for text, style in runs:
+            for word in text.split():
+                w = font.getlength(word)
+                if x > margin and x + w > width - margin:
+                    x = margin
+                    y += line_height
+                words.append((x, y, word, w, style))
+                x += w + space
+        y += line_height + FONT_SIZE
+
+    height = max(min_height, y + margin)
+    image = Image.new("RGB", (width, height), "white")
+    canvas = ImageDraw.Draw(image)
+    if url:
+        canvas.rectangle([0, 0, width, header_height], fill=HEADER_COLOR)
+        canvas.line([0, header_height, width, header_height], fill=BORDER_COLOR)
+        w = font.getlength(url)
+        canvas.text(((width - w) / 2, 10), url, fill=LINK_COLOR, font=font)
+    for i, (x, y, word, w, style) in enumerate(words):
+        if style:
+            # run the highlight on under the space to the next changed word
+            after = words[i + 1] if i + 1 < len(words) else None
+            if after and after[1] == y and after[4] == style:
+                w = after[0] - x
+            canvas.rectangle([x, y, x + w, y + line_height], fill=COLORS[style])
+        canvas.text((x, y + (line_height - FONT_SIZE) / 2), word, fill=TEXT_COLOR,
+                    font=font)
+    return image
+
+
+def draw_diff(html_path, screenshot_path, thumbnail_path, font=None):
+    """
+    Draws the screenshot and thumbnail for the diff page at html_path.
+    """
+    with open(html_path, encoding="utf8") as fh:
+        url, paragraphs = parse(fh.read())
+    font = font or load_font()
+    image = draw(paragraphs, SCREENSHOT_WIDTH, SCREENSHOT_HEIGHT, url, font)
+    image.save(screenshot_path, "JPEG", quality=85)
+    image = draw(clip(paragraphs), THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT, None, font)
+    image.save(thumbnail_path, "JPEG", quality=85)
+
+
+@lru_cache(maxsize=8)
+def load_font(path=None, size=FONT_SIZE):
+    """
+    Returns the TrueType font at path, or DejaVu Sans if it is installed,
+    or else Pillow's built in font.
+    """
+    from PIL import ImageFont
+    for name in filter(None, [path, "DejaVuSans.ttf"]):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            pass
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        # Pillow before 10.1 only has a small bitmap font
+        return ImageFont.load_default()
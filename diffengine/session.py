@@ -0,0 +1,102 @@
+"""
+A shared HTTP session for everything diffengine fetches. Connections to
+the same host are pooled and kept alive between requests, transient
+errors are retried with backoff and responses are capped in size.
+"""
+
+# urllib3 will only decode brotli if one of these is installed
+try:
+    import brotli
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    try:
+        import brotlicffi
+        ACCEPT_ENCODING = "gzip, deflate, br"
+    except ImportError:
+        ACCEPT_ENCODING = "gzip, deflate"
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+class Session(object):
+
+    def __init__(self, user_agent=None, pool_connections=10, pool_maxsize=10,
+                 retries=3, backoff=0.5, max_size=10 * 1024 * 1024,
+                 timeout=60, max_backoff=10,
+                 retry_statuses=(500, 502, 503, 504)):
+        # imported here so that importing diffengine doesn't pay for requests
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.timeout = timeout
+        self.max_size = max_size
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+        if user_agent:
+            self.session.headers["User-Agent"] = user_agent
+
+        # a 429, or a Retry-After of an hour, goes straight back to the
+        # caller rather than tying up a thread sleeping on it
+        options = dict(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=retry_statuses,
+            respect_retry_after_header=False,
+            raise_on_status=False
+        )
+        try:
+            retry = Retry(backoff_max=max_backoff, **options)
+        except TypeError:
+            # urllib3 before 2.0 always caps backoff at 120 seconds
+            retry = Retry(**options)
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=retry
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, url, headers=None, timeout=None):
+        """
+        Gets the url and returns the requests response with its body read.
+        ResponseTooLarge is raised, and the connection dropped, as soon as
+        the body is known to be bigger than max_size.
+        """
+        resp = self.session.get(url, headers=headers, stream=True,
+                                timeout=timeout or self.timeout)
+        try:
+            length = resp.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > self.max_size:
+                raise ResponseTooLarge("%s is %s bytes" % (url, length))
+
+            size = 0
+            chunks = []
+            for chunk in resp.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > self.max_size:
+                    raise ResponseTooLarge("%s is over %s bytes" % (url, self.max_size))
+                chunks.append(chunk)
+        except Exception:
+            resp.close()
+            raise
+
+        # hand the body back to requests so resp.content and resp.text work
+        resp._content = b"".join(chunks)
+        resp._content_consumed = True
+        return resp
+
+    def open(self, url, headers=None, timeout=None):
+        """
+        Gets the url and returns the requests response without reading its
+        body, for reading a bit at a time with iter_content. The caller
+        needs to close the response when it is done with it.
+        """
+        return self.session.get(url, headers=headers, stream=True,
+                                timeout=timeout or self.timeout)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,263 @@
+"""
+Capturing the feeds and pages that diffengine fetches in WARC files, and
+serving them again later in place of the network. With the raw responses
+kept, a newer readability or different exclusion rules can be tried out
+on what was actually fetched, performance runs can be repeated exactly,
+and tests don't depend on publishers' sites staying the same.
+
+Each record is its own gzip member, so a record can be read by seeking
+straight to it, and files are rotated once they reach max_size. Alongside
+the WARC files each writer keeps an index, one line per record:
+
+    url timestamp status filename offset length run
+
+where run identifies the round of fetching that a process was doing, so
+that a replay can go through the rounds in the order they happened. Each
+redirect on the way to a page is a record of its own, under the url that
+was asked for, and replays follow them just as requests did. requests has
+already undone any content encoding by the time a response is captured,
+so the body is stored decoded, with its Content-Length adjusted to suit.
+"""
+
+import os
+import glob
+import uuid
+import zlib
+import socket
+import logging
+import threading
+import tempfile
+
+from datetime import datetime
+from urllib.parse import urljoin
+
+# http headers that no longer describe the body once requests decodes it
+_hop_headers = {"content-encoding", "transfer-encoding", "content-length"}
+
+
+class WarcWriter(object):
+
+    def __init__(self, directory, max_size=1024 ** 3, software="diffengine"):
+        self.directory = directory
+        self.max_size = max_size
+        self.software = software
+        self.name = "%s-%s" % (datetime.utcnow().strftime("%Y%m%d%H%M%S"), os.getpid())
+        self.index_path = os.path.join(directory, "diffengine-%s.cdx" % self.name)
+        self.lock = threading.Lock()
+        self.file = None
+        self.sequence = 0
+        self.runs = 0
+        self.new_run()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def new_run(self):
+        """
+        Starts a new round of fetching, which a daemon does over and over.
+        """
+        with self.lock:
+            self.runs += 1
+            self.run = "%s-%05d" % (self.name, self.runs)
+
+    def write(self, resp, body=None, truncated=False):
+        """
+        Writes a requests response, and any redirects that led to it, to
+        the current WARC file. body can be a file with the body in it, for
+        responses that were streamed rather than read into resp.content.
+        truncated says that the body stops short of what the server sent.
+        """
+        for hop in resp.history:
+            hop_body = tempfile.SpooledTemporaryFile()
+            # requests reads the body of a redirect before following it
+            if hop._content_consumed and hop._content:
+                hop_body.write(hop._content)
+            self._write(hop, hop_body)
+        self._write(resp, body, truncated)
+
+    def _write(self, resp, body=None, truncated=False):
+        if body is None:
+            body = tempfile.SpooledTemporaryFile()
+            body.write(resp.content)
+        body.seek(0, os.SEEK_END)
+        body_length = body.tell()
+        body.seek(0)
+
+        http = ["HTTP/1.1 %s %s" % (resp.status_code, resp.reason or "")]
+        for name, value in resp.headers.items():
+            if name.lower() not in _hop_headers:
+                http.append("%s: %s" % (name, value))
+        http.append("Content-Length: %s" % body_length)
+        http = ("\r\n".join(http) + "\r\n\r\n").encode("utf8")
+
+        now = datetime.utcnow()
+        headers = [
+            "WARC/1.1",
+            "WARC-Type: response",
+            "WARC-Record-ID: <urn:uuid:%s>" % uuid.uuid4(),
+            "WARC-Date: %s" % now.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "WARC-Target-URI: %s" % resp.url,
+            "Content-Type: application/http;msgtype=response",
+            "Content-Length: %s" % (len(http) + body_length),
+        ]
+        if truncated:
+            headers.append("WARC-Truncated: unspecified")
+        head = ("\r\n".join(headers) + "\r\n\r\n").encode("utf8") + http
+
+        with self.lock:
+            offset, length = self._record(head, body)
+            line = "%s %s %s %s %s %s %s\n" % (
+                resp.url, now.strftime("%Y%m%d%H%M%S"), resp.status_code,
+                os.path.basename(self.file.name), offset, length, self.run)
+            with open(self.index_path, "a") as fh:
+                fh.write(line)
+            if self.file.tell() >= self.max_size:
+                self._close()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _record(self, head, body):
+        if self.file is None:
+            self._open()
+        offset = self.file.tell()
+        gz = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.file.write(gz.compress(head))
+        while True:
+            chunk = body.read(64 * 1024)
+            if not chunk:
+                break
+            self.file.write(gz.compress(chunk))
+        self.file.write(gz.compress(b"\r\n\r\n"))
+        self.file.write(gz.flush())
+        self.file.flush()
+        return offset, self.file.tell() - offset
+
+    def _open(self):
+        self.sequence += 1
+        name = "diffengine-%s-%05d.warc.gz" % (self.name, self.sequence)
+        self.file = open(os.path.join(self.directory, name), "ab")
+        logging.info("writing warc %s", self.file.name)
+        fields = ("software: %s\r\nhostname: %s\r\nformat: WARC File Format 1.1\r\n" %
+                  (self.software, socket.gethostname())).encode("utf8")
+        head = ("WARC/1.1\r\nWARC-Type: warcinfo\r\nWARC-Record-ID: <urn:uuid:%s>\r\n"
+                "WARC-Date: %s\r\nWARC-Filename: %s\r\n"
+                "Content-Type: application/warc-fields\r\nContent-Length: %s\r\n\r\n" %
+                (uuid.uuid4(), datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                 name, len(fields))).encode("utf8")
+        self._record(head + fields, _Empty())
+
+    def _close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class _Empty(object):
+
+    def read(self, size=-1):
+        return b""
+
+
+def tee(chunks, body):
+    """
+    Passes chunks through, copying them into the file body on the way.
+    """
+    for chunk in chunks:
+        body.write(chunk)
+        yield chunk
+
+
+class WarcArchive(object):
+    """
+    Serves captured responses in place of a Session. Once run is set only
+    what was captured in that run or before it is served, the latest
+    capture of a url first, and anything that wasn't captured gets a 404,
+    so nothing ever goes out to the network. A 304 from a conditional get
+    has no body to replay, so the capture before it is served instead.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.run = None
+        # run -> (first timestamp, set of urls)
+        self.run_urls = {}
+        lines = []
+        for path in sorted(glob.glob(os.path.join(directory, "*.cdx"))):
+            with open(path) as fh:
+                for line in fh:
+                    parts = line.split()
+                    if len(parts) != 7:
+                        continue
+                    url, timestamp, status, filename, offset, length, run = parts
+                    lines.append((run, url, status, filename, int(offset), int(length)))
+                    first, urls = self.run_urls.setdefault(run, (timestamp, set()))
+                    urls.add(url)
+        self.ranks = dict((run, rank) for rank, run in enumerate(self.runs()))
+        # url -> [(rank of its run, status, filename, offset, length)] in order
+        self.captures = {}
+        lines.sort(key=lambda line: self.ranks[line[0]])
+        for run, url, status, filename, offset, length in lines:
+            self.captures.setdefault(url, []).append(
+                (self.ranks[run], status, filename, offset, length))
+        logging.info("replaying %s urls from %s", len(self.captures), directory)
+
+    def runs(self):
+        """
+        Returns the runs that were captured, in the order they started.
+        """
+        return sorted(self.run_urls, key=lambda run: (self.run_urls[run][0], run))
+
+    def urls(self, run):
+        return self.run_urls[run][1]
+
+    def get(self, url, headers=None, timeout=None):
+        history = []
+        resp = self._response(url)
+        while resp.is_redirect and len(history) < 30:
+            history.append(resp)
+            resp = self._response(urljoin(resp.url, resp.headers["Location"]))
+        resp.history = history
+        return resp
+
+    def _response(self, url):
+        import requests
+        resp = requests.Response()
+        resp.url = url
+        captures = self.captures.get(url, [])
+        if self.run is not None:
+            rank = self.ranks[self.run]
+            captures = [c for c in captures if c[0] <= rank]
+        captures = [c for c in captures if c[1] != "304"] or captures
+        if not captures:
+            resp.status_code = 404
+            resp.reason = "Not Captured"
+            resp._content = b""
+            return resp
+
+        rank, status, filename, offset, length = captures[-1]
+        with open(os.path.join(self.directory, filename), "rb") as fh:
+            fh.seek(offset)
+            record = zlib.decompress(fh.read(length), 31)
+        warc_head, block = record.split(b"\r\n\r\n", 1)
+        size = 0
+        for line in warc_head.split(b"\r\n"):
+            if line.lower().startswith(b"content-length:"):
+                size = int(line.split(b":", 1)[1])
+        http_head, body = block[:size].split(b"\r\n\r\n", 1)
+        lines = http_head.decode("utf8").split("\r\n")
+        status = lines[0].split(" ", 2)
+        resp.status_code = int(status[1])
+        resp.reason = status[2] if len(status) > 2 else ""
+        resp.headers = requests.structures.CaseInsensitiveDict(
+            line.split(": ", 1) for line in lines[1:] if ": " in line)
+        resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+        resp._content = body
+        resp._content_consumed = True
+        return resp
+
+    def open(self, url, headers=None, timeout=None):
+        return self.get(url, headers, timeout)
+
+    def close(self):
+        pass
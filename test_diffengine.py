@@ -5,6 +5,7 @@ import pytest
 import shutil
 
 from diffengine import *
+from diffengine import _digest
 
 if os.path.isdir("test"):
     shutil.rmtree("test")
@@ -14,9 +15,36 @@ init("test", prompt=False)
 
 # the sequence of these tests is significant
 
+def forget_validators(e):
+    # the page itself hasn't changed, so make sure it gets parsed again
+    e.etag = e.last_modified = e.content_hash = None
+    e.save()
+
+def response(url, body, status=200, headers=None):
+    # a response as requests would have given it, without the network
+    import requests
+    from http.client import responses
+    resp = requests.Response()
+    resp.url = url
+    resp.status_code = status
+    resp.reason = responses.get(status, "")
+    resp.headers = requests.structures.CaseInsensitiveDict({
+        "Content-Type": "text/html; charset=utf-8"
+    })
+    resp.headers.update(headers or {})
+    resp._content = body.encode("utf8") if isinstance(body, str) else body
+    resp._content_consumed = True
+    return resp
+
 def test_version():
     assert setup.version in UA
 
+def test_db_setup():
+    assert db.execute_sql("PRAGMA journal_mode").fetchone()[0] == "wal"
+    indexes = [i.name for i in db.get_indexes("entryversion")]
+    assert "entryversion_url_created" in indexes
+    assert "entryversion_entry_id_created" in indexes
+
 def test_feed():
     f = Feed.create(name="Test", url="https://inkdroid.org/feed.xml")
     f.refresh_feed()
@@ -38,10 +66,15 @@ def test_diff():
     # remove some characters from the version
     v1.summary = v1.summary[0:-20]
     v1.save()
+    forget_validators(e)
 
     v2 = e.get_latest()
     assert type(v2) == EntryVersion
     assert v2.diff
+
+    # archiving happens in the outbox
+    outbox.drain()
+    v2 = EntryVersion.get(EntryVersion.id == v2.id)
     assert re.match("^https://wayback.archive.org/web/[0-9]+/.+$",
                     v2.archive_url) is not None
 
@@ -49,6 +82,9 @@ def test_diff():
     assert diff.old == v1
     assert diff.new == v2
     assert os.path.isfile(diff.html_path())
+
+    # screenshots are taken in the background
+    wait_for_screenshots()
     assert os.path.isfile(diff.screenshot_path())
     assert os.path.isfile(diff.thumbnail_path())
 
@@ -62,10 +98,26 @@ def test_html_diff():
     parts.insert(2, '<br>   \n')
     v1.summary = ' '.join(parts)
     v1.save()
+    forget_validators(e)
 
     v2 = e.get_latest()
     assert v2 is None
 
+def test_conditional_get():
+    f = Feed.get(Feed.url=="https://inkdroid.org/feed.xml")
+    e = f.entries[0]
+    assert e.content_hash
+
+    # an unchanged page is not turned into a new version
+    assert e.get_latest() is None
+
+    e.etag = '"abc"'
+    e.last_modified = 'Sat, 06 Jan 2018 00:00:00 GMT'
+    assert e.conditional_headers() == {
+        "If-None-Match": '"abc"',
+        "If-Modified-Since": 'Sat, 06 Jan 2018 00:00:00 GMT'
+    }
+
 def test_many_to_many():
 
     # these two feeds share this entry, we want diffengine to support
@@ -85,6 +137,13 @@ def test_many_to_many():
     e = Entry.get(Entry.url==url)
     assert FeedEntry.select().where(FeedEntry.entry==e).count() == 2
 
+def test_add_entries():
+    f = Feed.create(name="batch", url="https://example.com/batch.xml")
+    urls = ["https://example.com/a", "https://example.com/b"]
+    assert f.add_entries(urls) == 2
+    assert f.add_entries(urls + ["https://example.com/c"]) == 1
+    assert len(f.entries) == 3
+
 def test_bad_feed_url():
     # bad feed url shouldn't cause a fatal exception
     f = Feed.create(name="feed1", url="http://example.org/feedfeed.xml")
@@ -99,11 +158,210 @@ def test_whitespace():
     # add some whitespace
     v1.summary = v1.summary + "\n\n    "
     v1.save()
+    forget_validators(e)
 
     # whitespace should not count when diffing
     v2 = e.get_latest()
     assert v2 == None
 
+def test_schedule():
+    e = Entry(url="https://example.com/schedule")
+    e.created = datetime(2018, 1, 1)
+
+    # eight hours old, so due again in another two
+    e.checked = datetime(2018, 1, 1, 8)
+    assert e.schedule() == datetime(2018, 1, 1, 10)
+
+    # too old to bother with
+    e.checked = datetime(2018, 2, 15)
+    assert e.schedule() is None
+
+def test_due_entries():
+    f = Feed.get(Feed.url=="https://inkdroid.org/feed.xml")
+    e = f.entries[0]
+    e.next_check_at = datetime.utcnow() - timedelta(days=1)
+    e.save()
+
+    due = list(due_entries([f.url], 1))
+    assert len(due) == 1
+    assert due[0].id == e.id
+    assert due[0].feed_url == f.url
+
+def test_browser_pool():
+    from diffengine.browser import BrowserPool
+
+    class FakeBrowser:
+        closed = False
+        def quit(self):
+            self.closed = True
+
+    pool = BrowserPool(size=1, factory=FakeBrowser)
+    with pool.browser() as b1:
+        pass
+    with pool.browser() as b2:
+        pass
+    # the same browser is reused until the pool is closed
+    assert b1 is b2
+    pool.close()
+    assert b1.closed
+
+def test_daemon():
+    from diffengine.daemon import Daemon
+    d = Daemon()
+    d.configure()
+    d.feeds = []
+    d.options = {}
+    assert d.tick() == 0
+    assert d.seconds_until_due() == d.max_sleep
+
+    d.request_reload()
+    assert d.reload_requested
+    d.stop()
+    assert not d.running
+
+def test_session():
+    import time
+    import threading
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from diffengine.session import Session, ResponseTooLarge
+
+    hits = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            if self.path in ("/429", "/503"):
+                self.send_response(int(self.path[1:]))
+                self.send_header("Retry-After", "3600")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = b"x" * int(self.path.strip("/"))
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%s/" % server.server_address[1]
+
+    s = Session(user_agent=UA, max_size=1000)
+    assert s.get(url + "1000").content == b"x" * 1000
+    with pytest.raises(ResponseTooLarge):
+        s.get(url + "1001")
+
+    # 429s are the caller's to deal with, and nothing waits on Retry-After
+    s = Session(user_agent=UA, retries=2, backoff=0.01)
+    started = time.time()
+    assert s.get(url + "429").status_code == 429
+    assert s.get(url + "503").status_code == 503
+    assert time.time() - started < 5
+    assert hits.count("/429") == 1
+    assert hits.count("/503") == 3
+    server.shutdown()
+
+def test_fingerprint_column():
+    f = Feed.get(Feed.url=="https://inkdroid.org/feed.xml")
+    v = f.entries[0].versions[0]
+    assert v.fingerprint == _digest(v.summary)
+
+    # changing the summary changes the fingerprint
+    v.summary = v.summary + " more"
+    v.save()
+    assert v.fingerprint == _digest(v.summary)
+
+    # versions from before the column existed get filled in
+    EntryVersion.update(fingerprint=None).where(EntryVersion.id == v.id).execute()
+    assert backfill_fingerprints() >= 1
+    assert EntryVersion.get(EntryVersion.id == v.id).fingerprint == v.fingerprint
+
+def test_extract():
+    from diffengine.extract import Extractor
+    html = "<html><head><title>Hi</title></head><body><p>%s</p></body></html>"
+    html = html % ("Some words in a sentence, " * 20)
+    title, summary, fingerprint = Extractor().submit(html).result()
+    assert title == "Hi"
+    assert summary.startswith("<p>Some words")
+    assert fingerprint == _digest(summary)
+
+def test_extract_timeout():
+    import threading
+    from concurrent.futures import Future
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    import diffengine
+    from diffengine.extract import ExtractionTimeout
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"hi")
+        def log_message(self, *args):
+            pass
+
+    # an extractor that is slower than extract_timeout to get to a page,
+    # as when it is queued behind others, and times out on one of them
+    class SlowExtractor(object):
+        def submit(self, html, exclude=None):
+            future = Future()
+            def finish():
+                if future_urls[future].endswith("/slow"):
+                    future.set_exception(ExtractionTimeout())
+                else:
+                    future.set_result(("Hi", "<p>hi</p>", _digest("<p>hi</p>")))
+            future_urls[future] = urls.pop(0)
+            threading.Timer(2.5, finish).start()
+            return future
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:%s" % server.server_address[1]
+    urls = []
+    future_urls = {}
+    extractor = diffengine.extractor
+    diffengine.extractor = SlowExtractor()
+    diffengine.config['extract_timeout'] = 1
+    diffengine.config['concurrency'] = 1
+    try:
+        work = []
+        for path in ("/queued", "/slow"):
+            e = Entry.create(url=base + path)
+            urls.append(e.url)
+            work.append((e, False, None))
+        checked = [entry.url for entry, version in check_entries(work)]
+        # the page that waited its turn is still checked
+        assert checked == [base + "/queued"]
+    finally:
+        diffengine.extractor = extractor
+        del diffengine.config['extract_timeout']
+        del diffengine.config['concurrency']
+        server.shutdown()
+
+def test_delta_storage():
+    e = Entry.create(url="https://example.com/delta")
+    texts = ["<p>%s %s</p>" % ("lots of words " * 50, i) for i in range(5)]
+    previous = None
+    for text in texts:
+        v = EntryVersion(title="delta", url=e.url, summary=text, entry=e)
+        if previous:
+            v.delta_from(previous, keyframe_interval=3)
+        v.save()
+        previous = v
+
+    versions = list(EntryVersion.select()
+                    .where(EntryVersion.entry == e)
+                    .order_by(EntryVersion.id))
+    assert [v.chain for v in versions] == [0, 1, 2, 0, 1]
+    assert [v.summary for v in versions] == texts
+
+    # changing a version leaves the ones stored against it intact
+    versions[0].summary = "<p>changed</p>"
+    versions[0].save()
+    assert EntryVersion.get(EntryVersion.id == versions[1].id).summary == texts[1]
+
 def test_fingerprint():
     from diffengine import _fingerprint
     assert _fingerprint("foo bar") == "foobar"
@@ -111,3 +369,635 @@ def test_fingerprint():
     assert _fingerprint("foo<br>bar") == "foobar"
     assert _fingerprint("foo'bar") == "foobar"
     assert _fingerprint("foo’bar") == "foobar"
+
+def test_punctuation():
+    import unicodedata
+    from diffengine import punctuation
+    if unicodedata.unidata_version != punctuation.unicode_version:
+        pytest.skip("punctuation table is for unicode %s" % punctuation.unicode_version)
+    assert punctuation.build() == list(punctuation.ranges)
+
+def test_lazy_imports():
+    import sys
+    import subprocess
+    code = "import sys, diffengine; print(sorted(set(['selenium', 'tweepy', 'jinja2', 'feedparser', 'readability', 'htmldiff', 'requests']) & set(sys.modules)))"
+    out = subprocess.check_output([sys.executable, "-c", code])
+    assert out.strip() == b"[]"
+
+def test_throttle():
+    from diffengine.throttle import HostThrottle
+    t = HostThrottle(rate=10, burst=1)
+    assert t.wait("https://example.com/a") == 0
+    assert t.wait("https://example.com/b") > 0
+    # other hosts have their own bucket
+    assert t.wait("https://example.org/a") == 0
+
+def test_outbox():
+    import threading
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    import diffengine
+    from diffengine.outbox import Outbox
+
+    # a fake wayback machine that fails, then asks us to slow down, then
+    # works, with none of it retried by the session before the outbox sees it
+    responses = [(503, {}), (429, {"Retry-After": "3600"}),
+                 (200, {"Content-Location": "/web/20180101000000/http://example.com/"})]
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status, headers = responses.pop(0)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    diffengine.config['wayback_url'] = "http://127.0.0.1:%s/save/" % server.server_address[1]
+
+    e = Entry.create(url="http://example.com/")
+    v = EntryVersion.create(title="Example", url=e.url, summary="<p>hi</p>", entry=e)
+    box = Outbox(Job, workers=0, backoff=0)
+    job = box.put('archive', version=v)
+
+    # the first attempt fails and is retried straight away with no backoff,
+    # which is then rate limited and held without using up an attempt
+    box.drain()
+    job = Job.get(Job.id == job.id)
+    assert job.state == 'pending'
+    assert job.attempts == 1
+    assert job.run_at > datetime.utcnow() + timedelta(seconds=3000)
+    assert 'archive' in box.paused
+
+    # once the hold is over it goes through
+    box.paused.clear()
+    Job.update(run_at=datetime.utcnow()).where(Job.id == job.id).execute()
+    box.drain()
+    job = Job.get(Job.id == job.id)
+    assert job.state == 'done'
+    assert EntryVersion.get(EntryVersion.id == v.id).archive_url == \
+        "https://wayback.archive.org/web/20180101000000/http://example.com/"
+
+    # being told to retry straight away still holds the jobs for a while
+    responses.extend([(429, {"Retry-After": "0"})] * 100)
+    v = EntryVersion.create(title="Example", url=e.url, summary="<p>bye</p>", entry=e)
+    job = box.put('archive', version=v)
+    box.drain(2)
+    assert len(responses) == 99
+    assert Job.get(Job.id == job.id).state == 'pending'
+
+    server.shutdown()
+    del diffengine.config['wayback_url']
+
+def test_shard():
+    import diffengine
+    urls = ["https://example.com/feed%s.xml" % i for i in range(20)]
+    shards = [shard_of(url, 3) for url in urls]
+    assert shards == [shard_of(url, 3) for url in urls]
+    assert set(shards) == {0, 1, 2}
+
+    feeds = [{"url": url, "name": url} for url in urls]
+    picked = []
+    for i in range(3):
+        setup_shard("%s/3" % i)
+        picked.extend(f["url"] for f in shard_feeds(feeds))
+    setup_shard(None)
+    assert sorted(picked) == sorted(urls)
+    assert diffengine.shard is None
+
+    with pytest.raises(SystemExit):
+        parse_args(["--shard", "3/3"])
+
+    # a shard's backlog is only what is due in its own feeds
+    mine = Feed.create(name="mine", url="https://example.com/mine.xml")
+    theirs = Feed.create(name="theirs", url="https://example.com/theirs.xml")
+    mine.add_entries(["https://example.com/mine", "https://example.com/both"])
+    theirs.add_entries(["https://example.com/theirs", "https://example.com/both"])
+    Entry.update(next_check_at=datetime.utcnow() - timedelta(minutes=1)).where(
+        Entry.url << ["https://example.com/mine", "https://example.com/both",
+                      "https://example.com/theirs"]).execute()
+    assert count_due([mine.url]) == 2
+    assert count_due([mine.url, theirs.url]) == 3
+
+def test_leases():
+    import sys
+    import json
+    import subprocess
+
+    # several processes sharing the database race for the same leases
+    path = os.path.abspath(db.database)
+    code = "\n".join([
+        "import json, diffengine",
+        "diffengine.db.init(%r, timeout=30)" % path,
+        "names = ['entry:%s' % i for i in range(200)]",
+        "print(json.dumps(sorted(diffengine.claim_leases(names, 60))))",
+    ])
+    procs = [subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE)
+             for i in range(4)]
+    claims = [set(json.loads(p.communicate()[0].decode("utf8"))) for p in procs]
+
+    # every name went to exactly one of them
+    assert sum(len(c) for c in claims) == 200
+    assert set.union(*claims) == set("entry:%s" % i for i in range(200))
+
+    # live leases can't be taken, and released or expired ones can
+    assert claim_leases(["entry:0", "entry:1000"]) == {"entry:1000"}
+    release_leases(["entry:1000"])
+    assert claim_leases(["entry:1000"], owner="someone else") == {"entry:1000"}
+    Lease.update(expires=datetime.utcnow() - timedelta(seconds=1)).execute()
+    assert claim_leases(["entry:0"]) == {"entry:0"}
+    Lease.delete().execute()
+
+def test_force_https():
+    import diffengine
+    assert Feed.sanitize_url("http://example.com/a") == "https://example.com/a"
+    diffengine.config['force_https'] = False
+    assert Feed.sanitize_url("http://example.com/a") == "http://example.com/a"
+    del diffengine.config['force_https']
+
+def test_metrics():
+    import diffengine
+    from diffengine.metrics import Registry, Server
+
+    r = Registry()
+    c = r.counter("test_requests_total", "Requests", ["host"])
+    h = r.histogram("test_seconds", "Time", buckets=(0.1, 1))
+    c.inc(host="example.com")
+    c.inc(2, host="example.com")
+    h.observe(0.05)
+    h.observe(0.5)
+    text = r.render()
+    assert 'test_requests_total{host="example.com"} 3' in text
+    assert 'test_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_seconds_bucket{le="+Inf"} 2' in text
+    assert "test_seconds_count 2" in text
+    assert r.profile().splitlines()[1].startswith("test_seconds")
+
+    # queries are timed and the metrics written out after each run
+    db_seconds = metrics.registry.get("diffengine_db_seconds")
+    before = sum(count for key, count, total, biggest in db_seconds.summary())
+    Feed.select().count()
+    assert sum(count for key, count, total, biggest in db_seconds.summary()) == before + 1
+
+    diffengine.config['metrics_file'] = "metrics.prom"
+    check_due({}, 10)
+    text = open(home_path("metrics.prom")).read()
+    assert "diffengine_entries_checked_total" in text
+    assert "diffengine_screenshot_queue_depth 0" in text
+    del diffengine.config['metrics_file']
+
+    server = Server(r, 0, "127.0.0.1")
+    import urllib.request
+    url = "http://127.0.0.1:%s/metrics" % server.port
+    assert urllib.request.urlopen(url).read().decode("utf8") == r.render()
+    server.close()
+
+def test_paragraphs():
+    from diffengine import paragraphs
+    old = "<h1>Title</h1>\n\n" + "".join("<p>Paragraph %s of the story.</p>" % i for i in range(20))
+
+    # only the edited paragraph is word diffed
+    new = old.replace("Paragraph 7 of", "Paragraph 7 out of")
+    changes = paragraphs.compare(old, new)
+    assert changes.rendered_changes() == ["<p>Paragraph 7 <ins>out</ins> of the story.</p>"]
+    assert changes.render() == '<div class="diff">%s</div>' % \
+        new.replace("7 out", "7 <ins>out</ins>")
+
+    # paragraphs that are added and taken away
+    new = old.replace("<p>Paragraph 3 of the story.</p>", "") + "<p>The end.</p>"
+    assert paragraphs.compare(old, new).rendered_changes() == [
+        "<p><del>Paragraph 3 of the story.</del></p>",
+        "<p><ins>The end.</ins></p>"
+    ]
+
+    # changes to markup and spacing alone aren't changes
+    new = old.replace("Paragraph 5 of", "Paragraph 5 <br>\n of")
+    assert not paragraphs.compare(old, new).changed
+
+    # paragraphs that repeat or move still line up
+    assert paragraphs.match(list("xyxzy"), list("yxzxy")) == [(1, 0), (2, 1), (3, 2), (4, 4)]
+
+def test_word_spacing():
+    import random
+    from diffengine import paragraphs
+
+    def spaced(text):
+        return " ".join(text.split())
+
+    def sides(diff):
+        # what the old and new versions read as in a rendered diff
+        old = re.sub(r"</?del>", "", re.sub(r"<ins>.*?</ins>", "", diff))
+        new = re.sub(r"</?ins>", "", re.sub(r"<del>.*?</del>", "", diff))
+        return spaced(old), spaced(new)
+
+    assert paragraphs.compare("<p>one two three</p>", "<p>one two</p>").render() == \
+        '<div class="diff"><p>one two <del>three</del></p></div>'
+
+    vocabulary = "alpha beta gamma delta epsilon zeta eta theta iota kappa".split()
+    rand = random.Random(42)
+    for i in range(1000):
+        old = [rand.choice(vocabulary) for n in range(rand.randint(1, 10))]
+        new = list(old)
+        for n in range(rand.randint(1, 3)):
+            at = rand.randint(0, len(new))
+            edit = rand.choice(["insert", "delete", "replace"])
+            if edit != "insert" and at < len(new):
+                del new[at]
+            if edit != "delete":
+                new.insert(at, rand.choice(vocabulary))
+        old, new = " ".join(old), " ".join(new)
+        assert sides(paragraphs.words(old, new)) == (spaced(old), spaced(new))
+
+def test_exclude():
+    from diffengine import exclude
+    rules = exclude.rules_for({"exclude": [r"Last updated[^<]*"]},
+                              {"exclude": [r"(?i)\d+ views"]})
+    assert rules == (r"(?i)\d+ views", r"Last updated[^<]*")
+    pattern = exclude.compile_rules(rules)
+    assert exclude.compile_rules(rules) is pattern
+    assert exclude.apply(pattern, "<p>A story. 12 VIEWS</p><p>Last updated 3pm</p>") == \
+        "<p>A story.</p>"
+    # the flag only applies to the rule it is on
+    assert exclude.apply(pattern, "<p>last updated 3pm</p>") == "<p>last updated 3pm</p>"
+    assert exclude.compile_rules(exclude.rules_for({"exclude": []}, {})) is None
+    assert exclude.rules_for({}, {}) == exclude.DEFAULT_RULES
+
+def extracted(summary, pattern):
+    from diffengine import exclude
+    summary = exclude.apply(pattern, summary)
+    return "Title", summary, _digest(summary)
+
+def test_excluded_changes():
+    from diffengine import exclude
+
+    pattern = exclude.compile_rules(exclude.DEFAULT_RULES)
+    e = Entry.create(url="https://example.com/excluded")
+    page = "<p>A story.</p><p>Last updated %s</p><p>Comments (%s)</p>"
+    old = e.get_latest(False, resp=response(e.url, "first"),
+                       extracted=extracted(page % ("1pm", 3), pattern))
+    assert old.summary == "<p>A story.</p>"
+
+    # a new time and comment count alone aren't a new version
+    assert e.get_latest(False, resp=response(e.url, "second"),
+                        extracted=extracted(page % ("2pm", 4), pattern)) is None
+
+    # nor are they when the old version was saved without the rules
+    old.summary = page % ("1pm", 3)
+    old.save()
+    assert e.get_latest(False, resp=response(e.url, "third"),
+                        extracted=extracted(page % ("3pm", 5), pattern),
+                        exclude=pattern) is None
+    assert e.versions.count() == 1
+
+    # and when the story does change they are left out of the diff
+    new = e.get_latest(False, resp=response(e.url, "fourth"),
+                       extracted=extracted(page.replace("A", "An old") % ("4pm", 6),
+                                           pattern),
+                       exclude=pattern)
+    html = open(new.diff.html_path()).read()
+    assert "<ins>An old</ins>" in html
+    assert "Last updated" not in html
+
+    # a version whose diff can't be made isn't kept, nor is the diff
+    versions, diffs = EntryVersion.select().count(), Diff.select().count()
+    generate = Diff.generate
+    Diff.generate = lambda diff, path=None, exclude=None: False
+    try:
+        assert e.get_latest(False, resp=response(e.url, "fifth"),
+                            extracted=extracted(page % ("5pm", 7), pattern),
+                            exclude=pattern) is None
+    finally:
+        Diff.generate = generate
+    assert EntryVersion.select().count() == versions
+    assert Diff.select().count() == diffs
+
+def test_render():
+    from diffengine import render
+    assert render.environment() is render.environment()
+    html = render.page(title="Title", url="https://example.com/render",
+                       old_time=None, new_time=None,
+                       diff='<div class="diff"><p>A <del>short</del><ins>long</ins> story.</p></div>')
+    assert "jquery" not in html.lower()
+
+    url, paragraphs = render.parse(html)
+    assert url == "https://example.com/render"
+    assert paragraphs == [[("A ", None), ("short", "del"), ("long", "ins"), (" story.", None)]]
+
+    paragraphs = [[("Paragraph %s" % i, None)] for i in range(10)]
+    paragraphs[6].append(("changed", "ins"))
+    assert render.clip(paragraphs) == paragraphs[5:8]
+    assert render.clip(paragraphs[:3]) == paragraphs[:3]
+
+    path = home_path("render.html")
+    with open(path, "w") as fh:
+        fh.write(html)
+    render.draw_diff(path, home_path("render.jpg"), home_path("render-thumb.jpg"))
+    from PIL import Image
+    assert Image.open(home_path("render.jpg")).size == (1400, 1000)
+    assert Image.open(home_path("render-thumb.jpg")).size == (800, 400)
+
+def test_feed_reader():
+    from diffengine.feeds import FeedReader
+
+    def chunked(xml, size=50):
+        body = xml.encode("utf8")
+        return (body[i:i + size] for i in range(0, len(body), size))
+
+    items = "".join("<item><title>%s</title><link>https://example.com/%s</link></item>" % (i, i)
+                    for i in range(1000))
+    rss = '<?xml version="1.0"?><rss version="2.0"><channel><title>T</title>' \
+          '<image><url>https://example.com/logo.png</url></image>%s</channel></rss>' % items
+
+    # links come out as the feed is read, and reading can stop early
+    read = []
+    def counted(chunks):
+        for chunk in chunks:
+            read.append(chunk)
+            yield chunk
+    reader = FeedReader(counted(chunked(rss)))
+    links = iter(reader)
+    assert [next(links) for i in range(3)] == ["https://example.com/%s" % i for i in range(3)]
+    assert reader.kind == "rss"
+    assert len(read) < 10
+    assert not reader.complete
+
+    reader = FeedReader(chunked(rss))
+    assert len(list(reader)) == 1000
+    assert reader.complete
+
+    atom = '<feed xmlns="http://www.w3.org/2005/Atom"><link href="https://example.com/"/>' \
+           '<entry><link rel="enclosure" href="https://example.com/a.mp3"/>' \
+           '<link href="https://example.com/a"/></entry></feed>'
+    assert list(FeedReader(chunked(atom))) == ["https://example.com/a"]
+
+    sitemap = '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" ' \
+              'xmlns:news="http://www.google.com/schemas/sitemap-news/0.9">' \
+              '<url><loc>https://example.com/news/1</loc><news:news><news:title>One' \
+              '</news:title></news:news></url></urlset>'
+    reader = FeedReader(chunked(sitemap))
+    assert list(reader) == ["https://example.com/news/1"]
+    assert reader.kind == "sitemap"
+
+    # feedparser copes with feeds that aren't well formed
+    broken = rss.replace("<title>T</title>", "<title>T &nbsp; &</title>")
+    assert len(list(FeedReader(chunked(broken)))) == 1000
+
+    # and doesn't give the links read before the error again
+    broken = rss.replace("<title>500</title>", "<title>500 &nbsp; &</title>")
+    links = list(FeedReader(chunked(broken)))
+    assert links == ["https://example.com/%s" % i for i in range(1000)]
+
+def test_shared_versions():
+    summary = "<p>A wire story.</p>"
+    e1 = Entry.create(url="https://example.com/wire-1")
+    e2 = Entry.create(url="https://example.org/wire-2")
+    v1 = e1.get_latest(False, resp=response(e1.url, "one"),
+                       extracted=("Wire", summary, _digest(summary)))
+    v2 = e2.get_latest(False, resp=response(e2.url, "two"),
+                       extracted=("Wire", summary, _digest(summary)))
+    assert v2.same_as == v1.id
+    v2 = EntryVersion.get(EntryVersion.id == v2.id)
+    assert v2.stored_summary == ""
+    assert v2.summary == summary
+
+    # the same change to both only needs rendering once
+    changed = "<p>A longer wire story.</p>"
+    n1 = EntryVersion.create(title="Wire", url=e1.url, entry=e1, summary=changed)
+    d1 = Diff.create(old=v1, new=n1)
+    n2 = EntryVersion(title="Wire", url=e2.url, entry=e2, summary=changed)
+    assert n2.share()
+    n2.save()
+    d2 = Diff.create(old=v2, new=n2)
+    assert d2.share()
+    assert d2.same_as == d1.id
+    assert d2.html_path() == d1.html_path()
+    assert not d1.share()
+
+    # and only tweeting once from the same account
+    Job.create(kind="tweet", diff=d1, feed="https://example.com/wire.xml", state="done")
+    assert tweeted_copy(d2, "https://example.com/wire.xml")
+    assert not tweeted_copy(d1, "https://example.com/wire.xml")
+
+    # the other copies are checked as soon as one of them changes
+    e2.next_check_at = datetime.utcnow() + timedelta(hours=1)
+    e2.save()
+    assert e1.hurry_copies(v1) == 1
+    assert Entry.get(Entry.id == e2.id).next_check_at <= datetime.utcnow()
+
+    # versions sharing a summary that changes get their own copy
+    v1.summary = "<p>Corrected.</p>"
+    v1.save()
+    v2 = EntryVersion.get(EntryVersion.id == v2.id)
+    assert v2.same_as is None
+    assert v2.summary == summary
+
+def test_rerender():
+    import diffengine
+    diffengine.config['renderer'] = 'pillow'
+    setup_screenshots(workers=0)
+    try:
+        e = Entry.create(url="https://example.com/rerender")
+        old = EntryVersion.create(title="Rerender", url=e.url, entry=e,
+                                  summary="<p>Before.</p>")
+        new = EntryVersion.create(title="Rerender", url=e.url, entry=e,
+                                  summary="<p>Before and after.</p>")
+        diff = Diff.create(old=old, new=new)
+
+        counts = rerender(entries=[e.id], workers=0)
+        assert counts == {"rendered": 1, "skipped": 0, "unchanged": 0, "failed": 0}
+        path = diff.html_path().replace(".html", "-rerender.html")
+        assert "<ins>Before and after.</ins>" in open(path).read()
+        assert os.path.isfile(diff.thumbnail_path(path))
+        assert not os.path.isfile(diff.html_path())
+
+        assert rerender(entries=[e.id], workers=0, in_place=True)["rendered"] == 1
+        assert os.path.isfile(diff.html_path())
+        assert os.path.isfile(diff.thumbnail_path())
+
+        # the current exclusion rules are used
+        diffengine.config['exclude'] = [' and after']
+        assert rerender(entries=[e.id], workers=0)["unchanged"] == 1
+    finally:
+        diffengine.config.pop('exclude', None)
+        del diffengine.config['renderer']
+        setup_screenshots()
+
+def test_warc():
+    import gzip
+    from diffengine.warc import WarcWriter, WarcArchive
+
+    # the headers of the compressed body, which was decoded when it was read
+    sent = {"Content-Encoding": "gzip", "Content-Length": "3"}
+    directory = os.path.join("test", "warc")
+    writer = WarcWriter(directory, max_size=100)
+    writer.write(response("https://example.com/a", "<p>Café</p>", headers=sent))
+    writer.new_run()
+    writer.write(response("https://example.com/a", "<p>Two</p>", headers=sent))
+    writer.write(response("https://example.com/b", "", status=500, headers=sent))
+    # a feed link that redirects to the page
+    hop = response("http://example.com/old-d", "", status=301,
+                   headers=dict(sent, Location="https://example.com/d"))
+    moved = response("https://example.com/d", "<p>Moved</p>", headers=sent)
+    moved.history = [hop]
+    writer.write(moved)
+    writer.close()
+
+    # every record is a gzip member of its own, and files are rotated
+    warcs = sorted(f for f in os.listdir(directory) if f.endswith(".warc.gz"))
+    assert len(warcs) == 5
+    records = gzip.open(os.path.join(directory, warcs[0])).read()
+    assert records.startswith(b"WARC/1.1\r\nWARC-Type: warcinfo")
+    assert b"WARC-Type: response" in records
+    assert b"Content-Encoding" not in records
+
+    archive = WarcArchive(directory)
+    resp = archive.get("https://example.com/a")
+    assert resp.status_code == 200
+    assert resp.text == "<p>Two</p>"
+    assert resp.headers["Content-Length"] == "10"
+    assert list(resp.iter_content(4)) == [b"<p>T", b"wo</", b"p>"]
+    assert archive.get("https://example.com/b").status_code == 500
+    assert archive.get("https://example.com/c").status_code == 404
+
+    # redirects are followed from the url that was asked for
+    resp = archive.get("http://example.com/old-d")
+    assert resp.status_code == 200
+    assert resp.url == "https://example.com/d"
+    assert resp.text == "<p>Moved</p>"
+    assert [r.status_code for r in resp.history] == [301]
+
+    # only what was captured by the time of a run is served in it
+    first, second = archive.runs()
+    assert archive.urls(second) == {"https://example.com/a", "https://example.com/b",
+                                    "http://example.com/old-d", "https://example.com/d"}
+    archive.run = first
+    assert archive.get("https://example.com/a").text == "<p>Café</p>"
+    assert archive.get("https://example.com/b").status_code == 404
+
+def test_replay():
+    import diffengine
+    from diffengine.warc import WarcWriter
+
+    feed_url = "https://example.com/replay.xml"
+    url = "https://example.com/replay"
+    rss = '<?xml version="1.0"?><rss version="2.0"><channel><title>T</title>' \
+          '<item><link>%s</link></item></channel></rss>' % url
+    page = "<html><head><title>Hi</title></head><body><p>%s</p></body></html>" % \
+           ("Some words in a sentence, " * 20)
+
+    # fetched whole, and then conditionally with nothing new
+    directory = os.path.join("test", "replay")
+    writer = WarcWriter(directory)
+    writer.write(response(feed_url, rss))
+    writer.write(response(url, page, headers={"ETag": '"1"'}))
+    writer.new_run()
+    writer.write(response(feed_url, rss))
+    writer.write(response(url, "", status=304, headers={"ETag": '"1"'}))
+    writer.close()
+
+    # validators left over from the run that was captured
+    e = Entry.create(url=url, etag='"1"', content_hash=diffengine._content_hash(page.encode("utf8")))
+    feeds = diffengine.config.get('feeds')
+    diffengine.config['feeds'] = [{"name": "Replay", "url": feed_url}]
+    try:
+        assert replay(directory) == 2
+    finally:
+        diffengine.config['feeds'] = feeds
+    assert [v.title for v in e.versions] == ["Hi"]
+
+def test_adaptive_schedule():
+    from diffengine import scheduling
+    buckets = scheduling.buckets(2628000)
+    assert buckets[:3] == [(0, 3600), (3600, 7200), (7200, 14400)]
+    assert buckets[-1][1] == 2628000
+
+    # a feed that is only ever edited in its first hour
+    early = dict((i, (50 if i == 0 else 0, 100)) for i in range(len(buckets)))
+    quiet = dict((i, (0, 1000)) for i in range(len(buckets)))
+    model = scheduling.EditModel({"feed:early": early, "feed:quiet": quiet},
+                                 0.2, 60, 2628000)
+    assert model.wait(1800, "feed:early") < model.heuristic_wait(1800)
+    assert model.wait(7200, "feed:early") > model.heuristic_wait(7200)
+    assert model.wait(3 * 86400, "feed:quiet") is None
+    assert model.wait(8 * 3600, "feed:new") == 2 * 3600
+
+    # checking every hour catches both of these edits, checking once doesn't
+    assert scheduling.simulate(lambda age: 3600, [600, 5000], 3 * 3600) == (3, 2)
+    assert scheduling.simulate(lambda age: 3 * 3600, [600, 5000], 3 * 3600) == (1, 1)
+
+    # history is only counted once an entry has been checked through a
+    # bucket, and only once
+    now = datetime.utcnow().replace(microsecond=0)
+    f = Feed.create(name="Adaptive", url="https://example.com/adaptive.xml")
+    e = Entry.create(url="https://example.com/adaptive", created=now - timedelta(hours=3))
+    FeedEntry.create(feed=f, entry=e)
+    # one that stopped being checked half an hour in
+    dropped = Entry.create(url="https://example.com/adaptive-dropped", created=e.created,
+                           checked=e.created + timedelta(minutes=30), next_check_at=None)
+    FeedEntry.create(feed=f, entry=dropped)
+    v1 = EntryVersion.create(title="A", url=e.url, entry=e, summary="<p>A</p>")
+    v2 = EntryVersion.create(title="A", url=e.url, entry=e, summary="<p>B</p>")
+    Diff.create(old=v1, new=v2, created=e.created + timedelta(minutes=30))
+    learn_schedule(now, batch_size=1)
+    assert learn_schedule(now) == 0
+    stats = dict((s.bucket, (s.edits, s.exposure)) for s in
+                 EditStats.select().where(EditStats.key == "feed:" + f.url))
+    assert stats == {0: (1, 1), 1: (0, 1)}
+    # the next bucket isn't counted until the entry has been checked after it
+    learn_schedule(now + timedelta(hours=2))
+    assert not EditStats.select().where(EditStats.key == "feed:" + f.url,
+                                        EditStats.bucket == 2).exists()
+    e.checked = now + timedelta(hours=2)
+    e.save()
+    learn_schedule(now + timedelta(hours=3))
+    assert EditStats.get(key="feed:" + f.url, bucket=2).exposure == 1
+    assert EditStats.get(key="host:example.com", bucket=0).edits >= 1
+
+    report = schedule_report()
+    assert report[f.url]["edits"] == 1
+    assert report[None]["entries"] >= 1
+
+def test_artifacts():
+    import diffengine
+    from diffengine.artifacts import ArtifactStore
+
+    store = ArtifactStore(os.path.join("test", "store"))
+    digest = store.put(b"hello", ".txt")
+    assert store.put(b"hello", ".txt") == digest
+    assert store.path(digest, ".txt").endswith(os.path.join(digest[:2], digest[2:4], digest + ".txt"))
+    assert open(store.path(digest, ".txt"), "rb").read() == b"hello"
+
+    diffengine.config.update(renderer='pillow', artifact_store=True)
+    setup_artifacts()
+    setup_screenshots(workers=0)
+    try:
+        e = Entry.create(url="https://example.com/artifacts")
+        old = EntryVersion.create(title="Stored", url=e.url, entry=e, summary="<p>Before.</p>")
+        new = EntryVersion.create(title="Stored", url=e.url, entry=e, summary="<p>After.</p>")
+        diff = Diff.create(old=old, new=new)
+        assert diff.generate()
+
+        # the files move into the store and the index says where
+        assert Artifact.select().where(Artifact.diff == diff).count() == 3
+        assert diff.html_path().startswith(diffengine.artifact_store.root)
+        assert os.path.isfile(diff.html_path())
+        assert open(diff.thumbnail_path(), "rb").read(2) == b"\xff\xd8"
+        assert not os.path.isfile(diff.work_path())
+        thumbnail = diff.thumbnail_path()
+
+        # rendering it again the same way keeps the same files
+        assert rerender(entries=[e.id], workers=0, in_place=True)["rendered"] == 1
+        assert diff.thumbnail_path() == thumbnail
+        assert Artifact.select().where(Artifact.diff == diff).count() == 3
+
+        diffengine.config['artifact_retention'] = {'screenshot': 30}
+        screenshot = diff.screenshot_path()
+        assert prune_artifacts(datetime.utcnow() + timedelta(days=31)) >= 1
+        assert not os.path.isfile(screenshot)
+        assert os.path.isfile(diff.thumbnail_path())
+    finally:
+        for key in ('renderer', 'artifact_store', 'artifact_retention'):
+            diffengine.config.pop(key, None)
+        setup_artifacts()
+        setup_screenshots()